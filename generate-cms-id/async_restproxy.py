@@ -0,0 +1,356 @@
+# Copyright 2015 Alcatel-Lucent USA Inc.
+# All Rights Reserved.
+
+"""asyncio client for the VSD REST API.
+
+AsyncRESTProxyServer mirrors RESTProxyServer from restproxy.py: the same
+constructor arguments, the same rest_call/generate_nuage_auth semantics
+and the same (status, reason, raw, parsed) result tuple, but every call
+is a coroutine. It needs Python 3.7 or later.
+"""
+
+import asyncio
+import base64
+import json
+import logging
+import ssl
+import time
+
+from restproxy import POOL_IDLE_TIMEOUT
+from restproxy import POOL_SIZE
+from restproxy import RESTProxyConnectionError
+from restproxy import RetryPolicy
+from restproxy import _parse_retry_after
+
+LOG = logging.getLogger(__name__)
+MAX_CONCURRENCY = 64
+
+
+class _Response(object):
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    @property
+    def will_close(self):
+        return self.headers.get('connection', '').lower() == 'close'
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+
+class _StaleConnection(Exception):
+    """A pooled connection was closed by VSD before it answered."""
+
+
+class AsyncConnectionPool(object):
+    """Pool of keep-alive asyncio stream connections to one VSD node."""
+
+    def __init__(self, server, port, serverssl, timeout,
+                 maxsize=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.server = server
+        self.port = port or (443 if serverssl else 80)
+        self.ssl = ssl._create_unverified_context() if serverssl else None
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._idle = []
+
+    async def get(self):
+        """Return a ((reader, writer), reused) tuple."""
+        now = time.time()
+        while self._idle:
+            conn, released = self._idle.pop()
+            if now - released <= self.idle_timeout:
+                return conn, True
+            conn[1].close()
+        conn = await asyncio.wait_for(
+            asyncio.open_connection(self.server, self.port, ssl=self.ssl),
+            self.timeout)
+        return conn, False
+
+    def put(self, conn):
+        if len(self._idle) < self.maxsize:
+            self._idle.append((conn, time.time()))
+        else:
+            conn[1].close()
+
+    def clear(self):
+        idle, self._idle = self._idle, []
+        for conn, _released in idle:
+            conn[1].close()
+
+
+async def _read_body(reader, action, status, headers):
+    # These responses have no body, whatever their headers say
+    if action == 'HEAD' or status < 200 or status in (204, 304):
+        return b''
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if not size:
+                # trailers, up to the final empty line
+                while (await reader.readline()).strip():
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+    if 'content-length' in headers:
+        return await reader.readexactly(int(headers['content-length']))
+    if headers.get('connection', '').lower() == 'close':
+        return await reader.read()
+    # A keep-alive response without a length has no body: reading up to
+    # EOF would wait until VSD drops the idle connection.
+    return b''
+
+
+async def _http_request(conn, action, uri, body, headers):
+    reader, writer = conn
+    payload = body.encode('utf-8')
+    lines = ['%s %s HTTP/1.1' % (action, uri),
+             'Content-Length: %d' % len(payload)]
+    lines.extend('%s: %s' % item for item in headers.items())
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') +
+                 payload)
+    await writer.drain()
+    status_line = await reader.readline()
+    if not status_line:
+        raise _StaleConnection()
+    _version, status, reason = (
+        status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+    response_headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+        if not line:
+            break
+        name, _sep, value = line.partition(':')
+        response_headers[name.strip().lower()] = value.strip()
+    status = int(status)
+    respbody = await _read_body(reader, action, status, response_headers)
+    return _Response(status, reason, response_headers,
+                     respbody.decode('utf-8'))
+
+
+class AsyncRESTProxyServer(object):
+    """asyncio counterpart of restproxy.RESTProxyServer.
+
+    :param max_concurrency: maximum number of requests in flight at once,
+        which also bounds the number of open connections to VSD.
+    :param pool_size: number of idle connections kept open, by default
+        max_concurrency so that a burst of calls does not close the
+        connections it opened.
+    """
+
+    def __init__(self, server, base_uri, serverssl,
+                 serverauth, auth_resource,
+                 organization, servertimeout=30,
+                 pool_size=None, pool_idle_timeout=POOL_IDLE_TIMEOUT,
+                 retry_policy=None, max_concurrency=MAX_CONCURRENCY):
+        try:
+            server_ip, port = server.split(":")
+        except ValueError:
+            server_ip = server
+            port = None
+        self.server = server_ip
+        self.port = int(port) if port else None
+        self.base_uri = base_uri
+        self.serverssl = serverssl
+        self.serverauth = serverauth
+        self.auth_resource = auth_resource
+        self.organization = organization
+        self.timeout = servertimeout
+        self.auth = None
+        self.success_codes = range(200, 207)
+        self.retry_policy = retry_policy or RetryPolicy()
+        if pool_size is None:
+            pool_size = max_concurrency
+        self.pool = AsyncConnectionPool(self.server, self.port, serverssl,
+                                        servertimeout, maxsize=pool_size,
+                                        idle_timeout=pool_idle_timeout)
+        self.max_concurrency = max_concurrency
+        # Created on first use: before Python 3.10 they bind to the loop
+        # current when they are created, which may not be the one the
+        # calls run in.
+        self._semaphore = None
+        self._auth_lock = None
+
+    def close(self):
+        self.pool.clear()
+
+    async def _send(self, action, uri, body, headers):
+        conn, reused = await self.pool.get()
+        while True:
+            try:
+                response = await asyncio.wait_for(
+                    _http_request(conn, action, uri, body, headers),
+                    self.timeout)
+            except (_StaleConnection, ConnectionError,
+                    asyncio.IncompleteReadError) as e:
+                conn[1].close()
+                if not reused:
+                    raise ConnectionError('%s closed the connection, %r' %
+                                          (self.server, e))
+                # VSD closed the idle keep-alive socket, reconnect.
+                LOG.debug('RESTProxy: reconnecting stale connection, %r', e)
+                conn, reused = await self.pool.get()
+                continue
+            except BaseException:
+                # Includes cancellation: the connection is in an unknown
+                # state, so it must not go back to the pool.
+                conn[1].close()
+                raise
+            if response.will_close:
+                conn[1].close()
+            else:
+                self.pool.put(conn)
+            return response
+
+    def _headers(self, extra_headers=None):
+        headers = {}
+        if self.port:
+            headers['Host'] = '%s:%d' % (self.server, self.port)
+        else:
+            headers['Host'] = self.server
+        headers['Content-type'] = 'application/json'
+        headers['X-Nuage-Organization'] = self.organization
+        if self.auth:
+            headers['Authorization'] = self.auth
+        if extra_headers:
+            headers.update(extra_headers)
+        return headers
+
+    async def _send_limited(self, action, uri, body, extra_headers):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            if self._auth_lock is not None and self._auth_lock.locked():
+                # Do not send a key that is being replaced
+                async with self._auth_lock:
+                    pass
+            # Built once a slot is free: the API key may have been
+            # renewed while this call was waiting for it.
+            headers = self._headers(extra_headers)
+            LOG.debug('Request headers: %s', headers)
+            return await self._send(action, uri, body, headers)
+
+    async def _rest_call(self, action, resource, data, extra_headers=None,
+                         limited=True):
+        """Run a REST call with retries.
+
+        :param limited: False to run the call outside of max_concurrency,
+            for the authentication the other calls may be waiting for.
+        """
+        uri = self.base_uri + resource
+        body = json.dumps(data)
+
+        LOG.debug('Request uri: %s', uri)
+        LOG.debug('Request body: %s', body)
+
+        policy = self.retry_policy
+        if policy.deadline is not None:
+            deadline = time.time() + policy.deadline
+        else:
+            deadline = None
+        # Retries done so far, per status code (None for socket errors).
+        attempts = {}
+        while True:
+            try:
+                if limited:
+                    response = await self._send_limited(action, uri, body,
+                                                        extra_headers)
+                else:
+                    headers = self._headers(extra_headers)
+                    LOG.debug('Request headers: %s', headers)
+                    response = await self._send(action, uri, body, headers)
+            except (OSError, asyncio.TimeoutError) as e:
+                LOG.error('ServerProxy: %(action)s failure, %(e)r',
+                          {'action': action, 'e': e})
+                status = None
+                retry_after = None
+                error = e
+            else:
+                LOG.debug('Response status is %(st)s and reason is %(res)s',
+                          {'st': response.status,
+                           'res': response.reason})
+                LOG.debug('Response data is %s', response.body)
+                status = response.status
+                if not policy.retries_allowed(status):
+                    break
+                retry_after = _parse_retry_after(
+                    response.getheader('Retry-After'))
+
+            attempt = attempts.get(status, 0)
+            delay = policy.delay(attempt, retry_after)
+            if attempt >= policy.retries_allowed(status):
+                LOG.error('RESTProxy: Max retries exceeded')
+            elif deadline is not None and time.time() + delay > deadline:
+                LOG.error('RESTProxy: Retry deadline exceeded')
+            else:
+                attempts[status] = attempt + 1
+                # The semaphore is not held while backing off
+                await asyncio.sleep(delay)
+                continue
+            if status is None:
+                raise RESTProxyConnectionError(
+                    'Could not reach %s: %r' % (self.server, error))
+            break
+
+        respdata = response.body
+        if response.status in self.success_codes:
+            try:
+                respdata = json.loads(response.body)
+            except ValueError:
+                # response was not JSON, ignore the exception
+                pass
+        return response.status, response.reason, response.body, respdata
+
+    def _basic_auth(self, credentials):
+        return 'Basic ' + base64.b64encode(
+            credentials.encode('utf-8')).decode('ascii')
+
+    async def generate_nuage_auth(self):
+        resp = await self._rest_call(
+            'GET', self.auth_resource, '',
+            extra_headers={'Authorization': self._basic_auth(
+                self.serverauth)}, limited=False)
+        if resp[0] in self.success_codes and resp[3][0]['APIKey']:
+            respkey = resp[3][0]['APIKey']
+        else:
+            assert 0, 'Could not authenticate to REST server. Abort'
+        uname = self.serverauth.split(':')[0]
+        self.auth = self._basic_auth(uname + ':' + respkey)
+
+    async def _reauthenticate(self, stale_auth):
+        # Coroutines that all saw a 401 for the same key share a single
+        # re-authentication; the others reuse its result.
+        if self._auth_lock is None:
+            self._auth_lock = asyncio.Lock()
+        async with self._auth_lock:
+            if self.auth == stale_auth:
+                await self.generate_nuage_auth()
+
+    async def rest_call(self, action, resource, data, extra_headers=None):
+        auth = self.auth
+        response = await self._rest_call(action, resource, data,
+                                         extra_headers=extra_headers)
+        # If at all authentication expires with VSD, re-authenticate.
+        if response[0] == 401 and response[1] == 'Unauthorized':
+            await self._reauthenticate(auth)
+            return await self._rest_call(action, resource, data,
+                                         extra_headers=extra_headers)
+        return response
+
+    async def rest_call_many(self, requests):
+        """Run a batch of REST calls concurrently.
+
+        Concurrency is bounded by max_concurrency.
+
+        :param requests: iterable of (action, resource, data) or
+            (action, resource, data, extra_headers) tuples.
+        :returns: a list of rest_call results, in the order of requests.
+        """
+        return await asyncio.gather(
+            *[self.rest_call(*request) for request in requests])
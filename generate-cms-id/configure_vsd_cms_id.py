@@ -13,17 +13,64 @@
 #    under the License.
 import argparse
 import logging
+import os
 import sys
-from uuid import getnode
+
+# restproxy, json and uuid are imported where they are needed, so that
+# --help and argument errors return without loading them.
+
+SYS_CLASS_NET = '/sys/class/net'
+ARPHRD_ETHER = '1'
+
+
+def _read_sysfs(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _sysfs_mac():
+    """MAC of the only Ethernet interface of the host, if it has one.
+
+    uuid.getnode() picks an interface from the output of ifconfig, ip or
+    arp, in an order that depends on the Python version and on which of
+    them is installed, so sysfs cannot tell which one it would choose
+    among several. When every Ethernet interface has the same MAC there
+    is nothing to choose from, and the MAC is read without forking any
+    of them. Otherwise None is returned and getnode() decides, so that
+    the default CMS name stays the one of earlier runs.
+    """
+    try:
+        names = os.listdir(SYS_CLASS_NET)
+    except OSError:
+        return None
+    macs = set()
+    for name in names:
+        path = os.path.join(SYS_CLASS_NET, name)
+        mac = _read_sysfs(os.path.join(path, 'address'))
+        if (_read_sysfs(os.path.join(path, 'type')) != ARPHRD_ETHER or
+                not mac or mac == '00:00:00:00:00:00'):
+            continue
+        macs.add(mac.upper())
+    if len(macs) != 1:
+        return None
+    return macs.pop()
 
 
 def get_mac():
+    mac = _sysfs_mac()
+    if mac:
+        return mac
+    from uuid import getnode
     mac = getnode()
     return ':'.join(("%012X" % mac)[i:i + 2] for i in range(0, 12, 2))
 
-DEFAULT_CMS_NAME = 'OpenStack_' + get_mac()
 
-from restproxy import RESTProxyServer
+def default_cms_name():
+    return 'OpenStack_' + get_mac()
+
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -31,6 +78,7 @@ logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler())
 
 REST_SUCCESS_CODES = range(200, 207)
+CMS_IDS_FILE = 'cms_ids.json'
 
 
 def init_arg_parser():
@@ -48,28 +96,112 @@ def init_arg_parser():
                         help='VSD Server SSL')
     parser.add_argument('--base_uri', action='store', required=True,
                         help='Nuage Base URI')
-    parser.add_argument('--name', action='store',
-                        default=DEFAULT_CMS_NAME,
-                        help='The name of the CMS to create on VSD')
+    parser.add_argument('--credential_cache', action='store',
+                        help='File to share the VSD API key in between '
+                             'runs')
+    cms = parser.add_mutually_exclusive_group()
+    cms.add_argument('--name', action='store',
+                     help='The name of the CMS to create on VSD '
+                          '(default: OpenStack_<MAC address>)')
+    cms.add_argument('--manifest', action='store',
+                     help='File with one CMS name per line. Existing '
+                          'CMSes are reused and the missing ones are '
+                          'created, instead of creating --name')
+    parser.add_argument('--output', action='store', default=CMS_IDS_FILE,
+                        help='JSON file the CMS name to ID map is written '
+                             'to in --manifest mode')
     return parser
 
 
+def read_manifest(path):
+    names = []
+    with open(path) as f:
+        for line in f:
+            name = line.strip()
+            if name and not name.startswith('#') and name not in names:
+                names.append(name)
+    return names
+
+
+def find_cms(restproxy, names):
+    """Return a name to ID map of the CMSes among names that exist."""
+    name_filter = ' or '.join('name == "%s"' % name.replace('"', '\\"')
+                              for name in names)
+    return dict((cms['name'], cms['ID'])
+                for cms in restproxy.iter_collection('/cms',
+                                                     filter=name_filter)
+                if cms.get('name') in names)
+
+
+def provision_cms(restproxy, names):
+    """Return a name to ID map of names, creating the missing CMSes."""
+    cms_ids = find_cms(restproxy, names)
+    missing = [name for name in names if name not in cms_ids]
+    if missing:
+        logger.info('Creating %d of %d CMSes on VSD', len(missing),
+                    len(names))
+    responses = restproxy.rest_call_many(
+        [('POST', '/cms', {'name': name}) for name in missing])
+    conflicts = []
+    for name, response in zip(missing, responses):
+        if response[0] in REST_SUCCESS_CODES:
+            cms_ids[name] = response[3][0]['ID']
+        elif response[0] == 409:
+            # created by someone else since the lookup
+            conflicts.append(name)
+        else:
+            from restproxy import RESTProxyError
+            raise RESTProxyError('Failed to create CMS %s: %s' %
+                                 (name, response[2]), response[0])
+    if conflicts:
+        cms_ids.update(find_cms(restproxy, conflicts))
+    return cms_ids
+
+
 def main():
     parser = init_arg_parser()
     args = parser.parse_args()
 
+    from restproxy import FileCredentialCache
+    from restproxy import RESTProxyError
+    from restproxy import RESTProxyServer
+
+    credential_cache = None
+    if args.credential_cache:
+        credential_cache = FileCredentialCache(args.credential_cache)
+
     try:
         restproxy = RESTProxyServer(server=args.server,
                                     base_uri=args.base_uri,
                                     serverssl=args.serverssl,
                                     serverauth=args.serverauth,
                                     auth_resource=args.auth_resource,
-                                    organization=args.organization)
+                                    organization=args.organization,
+                                    credential_cache=credential_cache)
     except Exception as e:
         logger.error('Error in connecting to VSD:%s' % str(e))
         sys.exit(1)
 
-    response = restproxy.rest_call('POST', "/cms", {'name': args.name})
+    if args.manifest:
+        names = read_manifest(args.manifest)
+        try:
+            cms_ids = provision_cms(restproxy, names)
+        except RESTProxyError as e:
+            logger.error('Failed to create CMS on VSD:%s' % str(e))
+            sys.exit(1)
+        import json
+        with open(args.output, 'w') as f:
+            json.dump(cms_ids, f, indent=2, sort_keys=True)
+        logger.info("CMS IDs of %d CMSes stored in %s", len(cms_ids),
+                    args.output)
+        return
+
+    name = args.name or default_cms_name()
+    try:
+        response = restproxy.rest_call('POST', "/cms", {'name': name})
+    except RESTProxyError as e:
+        logger.error('Error in connecting to VSD:%s' % str(e))
+        sys.exit(1)
     if response[0] not in REST_SUCCESS_CODES:
         logger.error('Failed to create CMS on VSD.')
         sys.exit(1)
@@ -0,0 +1,351 @@
+# Copyright 2015 Alcatel-Lucent USA Inc.
+# All Rights Reserved.
+
+"""Local stand-in for the VSD REST API.
+
+MockVSD serves just enough of VSD to exercise RESTProxyServer and
+configure_vsd_cms_id.py without a real VSD: the auth resource (/me),
+/cms and paginated collections (X-Nuage-Page, X-Nuage-PageSize,
+X-Nuage-Count and X-Nuage-Filter on name). Faults can be injected
+through a Faults object: added latency, API key expiry, 503 storms and
+connection resets.
+
+It can also be run on its own:
+
+    python mock_vsd.py --port 8443 --latency 0.01 --unavailable 0.1
+"""
+
+import argparse
+import base64
+import json
+import random
+import re
+import socket
+import ssl
+import struct
+import threading
+import time
+import uuid
+
+try:
+    import BaseHTTPServer
+    import SocketServer
+except ImportError:
+    # Python 3
+    import http.server as BaseHTTPServer
+    import socketserver as SocketServer
+
+API_KEY_LIFETIME = 3600
+FILTER_RE = re.compile(r'''^\s*name\s*==\s*["'](.*)["']\s*$''')
+
+
+class Faults(object):
+    """Faults injected by MockVSD.
+
+    :param latency: seconds added to every response.
+    :param jitter: up to this many seconds added at random on top.
+    :param api_key_lifetime: seconds an API key stays valid. Requests
+        using an expired key are answered 401.
+    :param unavailable: probability of answering 503 to a request.
+    :param storm_every: if set, every storm_every seconds VSD answers all
+        requests with 503 for storm_duration seconds.
+    :param storm_duration: length of a 503 storm in seconds.
+    :param retry_after: value of the Retry-After header of 503 answers.
+    :param reset: probability of resetting the connection instead of
+        answering.
+    """
+
+    def __init__(self, latency=0, jitter=0, api_key_lifetime=API_KEY_LIFETIME,
+                 unavailable=0, storm_every=None, storm_duration=0,
+                 retry_after=None, reset=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.api_key_lifetime = api_key_lifetime
+        self.unavailable = unavailable
+        self.storm_every = storm_every
+        self.storm_duration = storm_duration
+        self.retry_after = retry_after
+        self.reset = reset
+
+    def in_storm(self, now):
+        if not self.storm_every:
+            return False
+        return now % self.storm_every < self.storm_duration
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this, Nagle and
+    # delayed ACKs add 40ms to every keep-alive response.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=None, headers=None, reason=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status, reason)
+        self.send_header('Content-Type', 'application/json')
+        # Like VSD, no Content-Length on the keep-alive 204 and 304
+        # answers, which have no body
+        if status not in (204, 304):
+            self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _reset(self):
+        # SO_LINGER with a zero timeout makes close() send a RST
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                   struct.pack('ii', 1, 0))
+        self.close_connection = True
+        self.connection.close()
+
+    def _handle(self):
+        vsd = self.server.vsd
+        faults = vsd.faults
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        vsd.count_request()
+
+        if faults.latency or faults.jitter:
+            time.sleep(faults.latency + random.uniform(0, faults.jitter))
+        if faults.reset and random.random() < faults.reset:
+            vsd.count('resets')
+            self._reset()
+            return
+        if (faults.unavailable and random.random() < faults.unavailable or
+                faults.in_storm(time.time())):
+            vsd.count('unavailable')
+            headers = {}
+            if faults.retry_after is not None:
+                headers['Retry-After'] = str(faults.retry_after)
+            self._reply(503, headers=headers)
+            return
+
+        if not self.path.startswith(vsd.base_uri):
+            self._reply(404)
+            return
+        resource = self.path[len(vsd.base_uri):].split('?', 1)[0]
+        authorization = self.headers.get('Authorization') or ''
+
+        if resource == vsd.auth_resource and self.command == 'GET':
+            apikey = vsd.login(authorization)
+            if apikey is None:
+                self._reply(401, reason='Unauthorized')
+            else:
+                self._reply(200, [apikey])
+            return
+        if not vsd.authorized(authorization):
+            vsd.count('unauthorized')
+            self._reply(401, reason='Unauthorized')
+            return
+
+        try:
+            data = json.loads(body.decode('utf-8')) if body else None
+        except ValueError:
+            self._reply(400)
+            return
+        status, result, headers = vsd.dispatch(self.command, resource,
+                                               data, self.headers)
+        self._reply(status, result, headers)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # The default backlog of 5 drops the SYNs of concurrent clients
+    # opening their connections at once, which then wait 1s to retry
+    request_queue_size = 128
+
+
+class MockVSD(object):
+    """In-process VSD stand-in serving HTTP, or HTTPS with a certificate.
+
+    :param username: user accepted by the auth resource.
+    :param password: password accepted by the auth resource.
+    :param base_uri: base URI of the API, as passed to RESTProxyServer.
+    :param collections: dict of resource to number of generated objects,
+        for example {'/vports': 10000}.
+    :param faults: Faults to inject.
+    :param certfile: PEM certificate and key to serve HTTPS with.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, username='csproot',
+                 password='csproot', base_uri='/nuage/api/v3_2',
+                 auth_resource='/me', collections=None, faults=None,
+                 certfile=None):
+        self.username = username
+        self.password = password
+        self.base_uri = base_uri
+        self.auth_resource = auth_resource
+        self.faults = faults or Faults()
+        self.objects = {'/cms': []}
+        for resource, count in (collections or {}).items():
+            self.objects[resource] = [
+                {'ID': str(uuid.uuid4()), 'name': '%s-%d' % (
+                    resource.strip('/'), index)}
+                for index in range(count)]
+        self.stats = {'requests': 0, 'logins': 0, 'unauthorized': 0,
+                      'unavailable': 0, 'resets': 0}
+        self._api_keys = {}
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.vsd = self
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.load_cert_chain(certfile)
+            self._server.socket = context.wrap_socket(self._server.socket,
+                                                      server_side=True)
+        self._thread = None
+
+    @property
+    def address(self):
+        """The \"ip:port\" string to pass to RESTProxyServer."""
+        return '%s:%d' % self._server.server_address[:2]
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def count_request(self):
+        self.count('requests')
+
+    def expire_api_keys(self):
+        with self._lock:
+            self._api_keys.clear()
+
+    @staticmethod
+    def _credentials(authorization):
+        if not authorization.startswith('Basic '):
+            return None, None
+        try:
+            decoded = base64.b64decode(authorization[6:].encode('ascii'))
+        except (TypeError, ValueError):
+            return None, None
+        user, _sep, secret = decoded.decode('utf-8').partition(':')
+        return user, secret
+
+    def login(self, authorization):
+        user, secret = self._credentials(authorization)
+        if user != self.username or secret != self.password:
+            return None
+        self.count('logins')
+        apikey = str(uuid.uuid4())
+        expiry = time.time() + self.faults.api_key_lifetime
+        with self._lock:
+            self._api_keys[apikey] = expiry
+        return {'ID': str(uuid.uuid4()), 'userName': user, 'APIKey': apikey,
+                'APIKeyExpiry': int(expiry * 1000)}
+
+    def authorized(self, authorization):
+        user, apikey = self._credentials(authorization)
+        if user != self.username:
+            return False
+        with self._lock:
+            expiry = self._api_keys.get(apikey)
+        return expiry is not None and time.time() < expiry
+
+    def dispatch(self, action, resource, data, headers):
+        parts = resource.rstrip('/').split('/')
+        collection = '/'.join(parts[:2])
+        with self._lock:
+            objects = self.objects.get(collection)
+            if objects is None:
+                return 404, None, None
+            if len(parts) == 2:
+                if action == 'GET':
+                    return self._page(objects, headers)
+                if action == 'POST':
+                    obj = dict(data or {})
+                    if any(o.get('name') == obj.get('name') for o in objects):
+                        return 409, None, None
+                    obj['ID'] = str(uuid.uuid4())
+                    objects.append(obj)
+                    return 201, [obj], None
+                return 405, None, None
+            matches = [o for o in objects if o['ID'] == parts[2]]
+            if not matches:
+                return 404, None, None
+            if action == 'GET':
+                return 200, matches, None
+            if action == 'PUT':
+                matches[0].update(data or {})
+                return 204, None, None
+            if action == 'DELETE':
+                objects.remove(matches[0])
+                return 204, None, None
+            return 405, None, None
+
+    @staticmethod
+    def _page(objects, headers):
+        name_filter = headers.get('X-Nuage-Filter')
+        if name_filter:
+            names = set()
+            for term in name_filter.split(' or '):
+                match = FILTER_RE.match(term)
+                if match:
+                    names.add(match.group(1))
+            objects = [o for o in objects if o.get('name') in names]
+        page = int(headers.get('X-Nuage-Page') or 0)
+        size = int(headers.get('X-Nuage-PageSize') or 500)
+        result = objects[page * size:(page + 1) * size]
+        response_headers = {'X-Nuage-Count': str(len(objects)),
+                            'X-Nuage-Page': str(page),
+                            'X-Nuage-PageSize': str(size)}
+        # VSD answers an empty page with an empty body
+        return 200, result or None, response_headers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--certfile',
+                        help='PEM certificate and key to serve HTTPS with')
+    parser.add_argument('--collection', action='append', default=[],
+                        metavar='RESOURCE=COUNT',
+                        help='Generated collection, e.g. /vports=10000')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--api_key_lifetime', type=float,
+                        default=API_KEY_LIFETIME)
+    parser.add_argument('--unavailable', type=float, default=0,
+                        help='Probability of a 503 answer')
+    parser.add_argument('--reset', type=float, default=0,
+                        help='Probability of a connection reset')
+    args = parser.parse_args()
+
+    collections = {}
+    for spec in args.collection:
+        resource, count = spec.split('=')
+        collections[resource] = int(count)
+    faults = Faults(latency=args.latency, jitter=args.jitter,
+                    api_key_lifetime=args.api_key_lifetime,
+                    unavailable=args.unavailable, reset=args.reset)
+    vsd = MockVSD(args.host, args.port, collections=collections,
+                  faults=faults, certfile=args.certfile)
+    print('Mock VSD listening on %s' % vsd.address)
+    try:
+        vsd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,55 @@
 # All Rights Reserved.
 
 import base64
-import httplib
+import collections
+import contextlib
+import email.utils
+import errno
+import fcntl
 import json
 import logging
+import os
+import random
+import re
 import socket
 import ssl
+import threading
 import time
 
+try:
+    import httplib
+    import Queue
+except ImportError:
+    # Python 3, for the asyncio client sharing this module
+    import http.client as httplib
+    import queue as Queue
+
 LOG = logging.getLogger(__name__)
 MAX_RETRIES = 5
 MAX_RETRIES_503 = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8
+POOL_SIZE = 4
+POOL_IDLE_TIMEOUT = 60
+MAX_WORKERS = 8
+PAGE_SIZE = 500
+CACHE_SIZE = 256
+CACHE_TTL = 30
+CREDENTIAL_REFRESH_AHEAD = 300
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 30
+LATENCY_DECAY = 0.3
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# VSD object IDs are UUIDs; numeric IDs are folded as well.
+RESOURCE_ID_RE = re.compile(r'/(?:[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-'
+                            r'[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+                            r'[0-9a-fA-F]{12}|\d+)(?=/|$)')
+
+# Errors raised when a pooled keep-alive socket was closed by VSD while it
+# sat idle in the pool. These are safe to retry on a fresh connection.
+STALE_CONN_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
 
 
 class RESTProxyBaseException(Exception):
@@ -50,34 +89,646 @@ class RESTProxyError(RESTProxyBaseException):
         super(RESTProxyError, self).__init__()
 
 
-class RESTProxyServer(object):
-    def __init__(self, server, base_uri, serverssl,
-                 serverauth, auth_resource,
-                 organization, servertimeout=30):
+class RESTProxyConnectionError(RESTProxyError):
+    """VSD could not be reached within the retry policy."""
+
+
+class RetryPolicy(object):
+    """Decides whether, and after how long, a failed VSD call is retried.
+
+    :param max_retries: retries allowed for socket errors.
+    :param status_retries: dict of HTTP status code to the number of
+        retries allowed for a response with that status. Statuses that
+        are not listed are never retried.
+    :param backoff_base: delay in seconds before the first retry. The
+        delay doubles with each further retry of the same kind.
+    :param backoff_max: upper bound in seconds for a single delay.
+    :param jitter: randomize each delay between half and all of its value
+        so that concurrent clients do not retry in lockstep.
+    :param deadline: time budget in seconds for one call, retries
+        included. None means no limit.
+    """
+
+    def __init__(self, max_retries=MAX_RETRIES, status_retries=None,
+                 backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX,
+                 jitter=True, deadline=None):
+        self.max_retries = max_retries
+        if status_retries is None:
+            status_retries = {503: MAX_RETRIES_503}
+        self.status_retries = dict(status_retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.deadline = deadline
+
+    def retries_allowed(self, status):
+        """Retries allowed for a status code, or None for socket errors."""
+        if status is None:
+            return self.max_retries
+        return self.status_retries.get(status, 0)
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait before retry number ``attempt`` (from 0)."""
+        if retry_after is not None:
+            return retry_after
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        if self.jitter:
+            delay = random.uniform(delay / 2.0, delay)
+        return delay
+
+
+def _parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+
+class Endpoint(object):
+    """A VSD node, with its observed latency and circuit breaker state.
+
+    :param failure_threshold: consecutive failures after which the node
+        is ejected.
+    :param cooldown: seconds an ejected node is skipped before it is
+        tried again.
+    """
+
+    def __init__(self, server, port, failure_threshold=BREAKER_THRESHOLD,
+                 cooldown=BREAKER_COOLDOWN):
+        self.server = server
+        self.port = port
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.latency = None
+        self.failures = 0
+        self.ejected_until = 0
+
+    def __repr__(self):
+        if self.port:
+            return '%s:%s' % (self.server, self.port)
+        return self.server
+
+    def available(self, now):
+        return now >= self.ejected_until
+
+    def succeeded(self, elapsed):
+        self.failures = 0
+        self.ejected_until = 0
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += LATENCY_DECAY * (elapsed - self.latency)
+
+    def failed(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.available(time.time()):
+                LOG.warning('RESTProxy: ejecting VSD %s for %ss',
+                            self, self.cooldown)
+            self.ejected_until = time.time() + self.cooldown
+
+
+def _parse_endpoints(server):
+    if not isinstance(server, (list, tuple)):
+        server = server.split(',')
+    endpoints = []
+    for address in server:
         try:
-            server_ip, port = server.split(":")
+            server_ip, port = address.strip().split(":")
         except ValueError:
-            server_ip = server
+            server_ip = address.strip()
             port = None
-        self.server = server_ip
-        self.port = int(port) if port else None
+        endpoints.append((server_ip, int(port) if port else None))
+    return endpoints
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of keep-alive connections to VSD.
+
+    Idle connections are kept per (server, port, ssl) key. At most
+    ``maxsize`` idle connections are kept for each key, and connections
+    that have been idle for longer than ``idle_timeout`` seconds are
+    closed instead of being handed out again.
+    """
+
+    def __init__(self, maxsize=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _connect(server, port, serverssl, timeout):
+        if serverssl:
+            if hasattr(ssl, '_create_unverified_context'):
+                # pylint: disable=no-member
+                # pylint: disable=unexpected-keyword-arg
+                return httplib.HTTPSConnection(
+                    server, port, timeout=timeout,
+                    context=ssl._create_unverified_context())
+                # pylint: enable=no-member
+                # pylint: enable=unexpected-keyword-arg
+            return httplib.HTTPSConnection(server, port, timeout=timeout)
+        return httplib.HTTPConnection(server, port, timeout=timeout)
+
+    def get(self, server, port, serverssl, timeout):
+        """Return a (connection, reused) tuple for the given endpoint."""
+        key = (server, port, bool(serverssl))
+        now = time.time()
+        expired = []
+        conn = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                candidate, released = idle.pop()
+                if now - released > self.idle_timeout:
+                    expired.append(candidate)
+                else:
+                    conn = candidate
+                    break
+        for stale in expired:
+            stale.close()
+        if conn is not None:
+            return conn, True
+        return self._connect(server, port, serverssl, timeout), False
+
+    def put(self, conn, server, port, serverssl):
+        """Return a connection whose response has been fully read."""
+        key = (server, port, bool(serverssl))
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def clear(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, _released in conns:
+                conn.close()
+
+
+def _is_stale_conn_error(exc):
+    if isinstance(exc, (httplib.BadStatusLine, httplib.CannotSendRequest)):
+        return True
+    if isinstance(exc, socket.timeout):
+        return False
+    return (isinstance(exc, socket.error) and
+            getattr(exc, 'errno', None) in STALE_CONN_ERRNOS)
+
+
+class ResponseCache(object):
+    """Bounded LRU cache of VSD GET responses.
+
+    Expired entries that carried an ETag are kept and revalidated with
+    If-None-Match instead of being fetched again. Cached results are
+    shared between callers and must not be modified.
+
+    :param maxsize: maximum number of cached responses.
+    :param ttl: default time to live of an entry, in seconds.
+    :param ttls: dict of resource prefix to time to live, for resources
+        that need a different TTL. The longest matching prefix wins.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL, ttls=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(resource, extra_headers=None):
+        return resource, tuple(sorted((extra_headers or {}).items()))
+
+    def _ttl_for(self, resource):
+        prefixes = [prefix for prefix in self.ttls
+                    if resource.startswith(prefix)]
+        if prefixes:
+            return self.ttls[max(prefixes, key=len)]
+        return self.ttl
+
+    def lookup(self, key):
+        """Return a (result, etag, fresh) tuple, or None on a miss."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            result, etag, expires = entry
+            fresh = time.time() < expires
+            if not fresh and not etag:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            if fresh:
+                self.hits += 1
+            return result, etag, fresh
+
+    def store(self, key, result, etag=None):
+        expires = time.time() + self._ttl_for(key[0])
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (result, etag, expires)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def revalidated(self, key):
+        """Extend the life of an entry VSD answered 304 Not Modified for."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                result, etag, _expires = entry
+                self._entries[key] = (
+                    result, etag, time.time() + self._ttl_for(key[0]))
+            self.revalidations += 1
+
+    def invalidate(self, resource):
+        """Drop a resource, its children and its parent collection."""
+        resource = resource.rstrip('/')
+        parent = resource.rsplit('/', 1)[0]
+        with self._lock:
+            for key in list(self._entries):
+                cached = key[0].split('?', 1)[0].rstrip('/')
+                if (cached == resource or cached == parent or
+                        cached.startswith(resource + '/')):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'revalidations': self.revalidations,
+                    'evictions': self.evictions}
+
+
+class CredentialCache(object):
+    """In-process cache of VSD API keys.
+
+    This is also the interface RESTProxyServer expects from credential
+    caches: get(), put() and a lock() context manager serializing the
+    refresh of a key.
+
+    :param refresh_ahead: seconds before APIKeyExpiry at which a cached
+        key is no longer handed out, so that it is refreshed in time.
+    """
+
+    def __init__(self, refresh_ahead=CREDENTIAL_REFRESH_AHEAD):
+        self.refresh_ahead = refresh_ahead
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return an (apikey, expiry) tuple, or None."""
+        return self._keys.get(key)
+
+    def put(self, key, apikey, expiry):
+        self._keys[key] = (apikey, expiry)
+
+    def lock(self, key):
+        return self._lock
+
+
+class FileCredentialCache(CredentialCache):
+    """API key cache shared between processes through a file.
+
+    The file is only readable by its owner. Updates are written to a
+    temporary file and renamed into place, and refreshes are serialized
+    with an flock() on a companion lock file, so that processes starting
+    together wait for one login instead of all logging in to VSD.
+    """
+
+    def __init__(self, path, refresh_ahead=CREDENTIAL_REFRESH_AHEAD):
+        super(FileCredentialCache, self).__init__(refresh_ahead)
+        self.path = os.path.expanduser(path)
+        self._thread_lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, key):
+        entry = self._load().get(key)
+        if not entry:
+            return None
+        return entry['APIKey'], entry['APIKeyExpiry']
+
+    def put(self, key, apikey, expiry):
+        keys = self._load()
+        keys[key] = {'APIKey': apikey, 'APIKeyExpiry': expiry}
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(keys, f)
+        os.rename(tmp_path, self.path)
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        with self._thread_lock:
+            fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+
+def resource_template(resource):
+    """'/enterprises/<uuid>/domains?x' -> '/enterprises/{id}/domains'."""
+    return RESOURCE_ID_RE.sub('/{id}', resource.split('?', 1)[0])
+
+
+class _CallStats(object):
+    __slots__ = ('buckets', 'count', 'latency', 'sent', 'received',
+                 'retries', 'unavailable', 'failures')
+
+    def __init__(self, nbuckets):
+        self.buckets = [0] * nbuckets
+        self.count = 0
+        self.latency = 0.0
+        self.sent = 0
+        self.received = 0
+        self.retries = 0
+        self.unavailable = 0
+        self.failures = 0
+
+
+class Metrics(object):
+    """Statistics of the calls made by a RESTProxyServer.
+
+    Calls are grouped by HTTP verb and resource template, the resource
+    with its object IDs replaced by {id}. For each group, a latency
+    histogram, bytes sent and received, retries, 503 responses and calls
+    that never got an answer are recorded. 401 responses that caused a
+    re-authentication and requests sent again on a new connection after
+    VSD closed an idle keep-alive one are counted globally.
+
+    :param buckets: upper bounds in seconds of the latency histogram.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.reauthentications = 0
+        self.reconnects = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def record_call(self, action, resource, elapsed, sent, received,
+                    retries=0, unavailable=0, failed=False):
+        key = (action, resource_template(resource))
+        with self._lock:
+            stats = self._calls.get(key)
+            if stats is None:
+                stats = self._calls[key] = _CallStats(len(self.buckets) + 1)
+            index = 0
+            for bound in self.buckets:
+                if elapsed <= bound:
+                    break
+                index += 1
+            stats.buckets[index] += 1
+            stats.count += 1
+            stats.latency += elapsed
+            stats.sent += sent
+            stats.received += received
+            stats.retries += retries
+            stats.unavailable += unavailable
+            stats.failures += int(failed)
+
+    def record_reauthentication(self):
+        with self._lock:
+            self.reauthentications += 1
+
+    def record_reconnect(self):
+        with self._lock:
+            self.reconnects += 1
+
+    def snapshot(self):
+        """Return the statistics as a JSON serializable dict."""
+        with self._lock:
+            calls = []
+            for (action, resource), stats in sorted(self._calls.items()):
+                calls.append({
+                    'method': action,
+                    'resource': resource,
+                    'count': stats.count,
+                    'latency_sum': stats.latency,
+                    'latency_buckets': dict(
+                        zip([str(b) for b in self.buckets] + ['+Inf'],
+                            stats.buckets)),
+                    'bytes_sent': stats.sent,
+                    'bytes_received': stats.received,
+                    'retries': stats.retries,
+                    'unavailable': stats.unavailable,
+                    'failures': stats.failures})
+            return {'calls': calls,
+                    'reauthentications': self.reauthentications,
+                    'reconnects': self.reconnects}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """Return the statistics in the Prometheus text format."""
+        snapshot = self.snapshot()
+        lines = ['# TYPE vsd_request_duration_seconds histogram']
+        for call in snapshot['calls']:
+            labels = 'method="%s",resource="%s"' % (call['method'],
+                                                      call['resource'])
+            cumulative = 0
+            for bound in [str(b) for b in self.buckets] + ['+Inf']:
+                cumulative += call['latency_buckets'][bound]
+                lines.append('vsd_request_duration_seconds_bucket{%s,le="%s"}'
+                             ' %d' % (labels, bound, cumulative))
+            lines.append('vsd_request_duration_seconds_sum{%s} %f' %
+                         (labels, call['latency_sum']))
+            lines.append('vsd_request_duration_seconds_count{%s} %d' %
+                         (labels, call['count']))
+        for name, field in (('vsd_request_sent_bytes_total', 'bytes_sent'),
+                            ('vsd_response_received_bytes_total',
+                             'bytes_received'),
+                            ('vsd_request_retries_total', 'retries'),
+                            ('vsd_response_unavailable_total',
+                             'unavailable'),
+                            ('vsd_request_failures_total', 'failures')):
+            lines.append('# TYPE %s counter' % name)
+            for call in snapshot['calls']:
+                lines.append('%s{method="%s",resource="%s"} %d' %
+                             (name, call['method'], call['resource'],
+                              call[field]))
+        lines.append('# TYPE vsd_reauthentications_total counter')
+        lines.append('vsd_reauthentications_total %d' %
+                     snapshot['reauthentications'])
+        lines.append('# TYPE vsd_reconnects_total counter')
+        lines.append('vsd_reconnects_total %d' % snapshot['reconnects'])
+        return '\n'.join(lines) + '\n'
+
+
+class _Prefetch(object):
+    """Runs a single call in a background thread."""
+
+    def __init__(self, func, *args):
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(func, args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args):
+        try:
+            self._result = func(*args)
+        except Exception as e:
+            self._error = e
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class RESTProxyServer(object):
+    def __init__(self, server, base_uri, serverssl,
+                 serverauth, auth_resource,
+                 organization, servertimeout=30,
+                 pool_size=POOL_SIZE, pool_idle_timeout=POOL_IDLE_TIMEOUT,
+                 retry_policy=None, cache=None, credential_cache=None,
+                 failure_threshold=BREAKER_THRESHOLD,
+                 cooldown=BREAKER_COOLDOWN, health_check_interval=None,
+                 metrics=None):
+        # server is "ip:port", or a list or comma separated string of
+        # them for a VSD cluster.
+        self.endpoints = [Endpoint(server_ip, port, failure_threshold,
+                                   cooldown)
+                          for server_ip, port in _parse_endpoints(server)]
+        self.server = self.endpoints[0].server
+        self.port = self.endpoints[0].port
         self.base_uri = base_uri
         self.serverssl = serverssl
         self.serverauth = serverauth
         self.auth_resource = auth_resource
         self.organization = organization
         self.timeout = servertimeout
-        self.retry = 0
-        self.retry_503 = 0
         self.auth = None
+        self._auth_lock = threading.Lock()
         self.success_codes = range(200, 207)
+        self.pool = ConnectionPool(maxsize=pool_size,
+                                   idle_timeout=pool_idle_timeout)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.cache = cache
+        self.credential_cache = credential_cache
+        self.metrics = metrics
+        self._endpoint_lock = threading.Lock()
+        self._closed = threading.Event()
+        if health_check_interval and len(self.endpoints) > 1:
+            checker = threading.Thread(target=self._health_check_loop,
+                                       args=(health_check_interval,))
+            checker.daemon = True
+            checker.start()
 
-    def _rest_call(self, action, resource, data, extra_headers=None):
-        if self.retry >= MAX_RETRIES:
-            LOG.error('RESTProxy: Max retries exceeded')
-            # Get ready for the next set of operation
-            self.retry = 0
-            return 0, None, None, None
+    def close(self):
+        self._closed.set()
+        self.pool.clear()
+
+    def check_endpoints(self):
+        """Probe every VSD node with a TCP connect, concurrently."""
+        def probe(endpoint):
+            port = endpoint.port or (443 if self.serverssl else 80)
+            start = time.time()
+            try:
+                sock = socket.create_connection((endpoint.server, port),
+                                                self.timeout)
+            except (socket.timeout, socket.error) as e:
+                LOG.warning('RESTProxy: health check of %s failed, %r',
+                            endpoint, e)
+                with self._endpoint_lock:
+                    endpoint.failed()
+                return
+            sock.close()
+            with self._endpoint_lock:
+                endpoint.succeeded(time.time() - start)
+
+        probes = [threading.Thread(target=probe, args=(endpoint,))
+                  for endpoint in self.endpoints]
+        for thread in probes:
+            thread.daemon = True
+            thread.start()
+        for thread in probes:
+            thread.join()
+
+    def _health_check_loop(self, interval):
+        while not self._closed.wait(interval):
+            self.check_endpoints()
+
+    def _pick_endpoint(self, tried):
+        """Healthy node with the lowest latency that was not tried yet."""
+        now = time.time()
+        with self._endpoint_lock:
+            candidates = [endpoint for endpoint in self.endpoints
+                          if endpoint not in tried] or self.endpoints
+            healthy = [endpoint for endpoint in candidates
+                       if endpoint.available(now)]
+            if not healthy:
+                # Every node is ejected, try the one back soonest.
+                return min(candidates, key=lambda e: e.ejected_until)
+            # Nodes without a latency sample yet are tried first.
+            return min(healthy, key=lambda e: e.latency or 0)
+
+    def _send(self, endpoint, action, uri, body, headers):
+        start = time.time()
+        conn, reused = self.pool.get(endpoint.server, endpoint.port,
+                                     self.serverssl, self.timeout)
+        while True:
+            try:
+                conn.request(action, uri, body, headers)
+                response = conn.getresponse()
+                respstr = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if not (reused and _is_stale_conn_error(e)):
+                    with self._endpoint_lock:
+                        endpoint.failed()
+                    raise
+                # VSD closed the idle keep-alive socket, reconnect.
+                LOG.debug('RESTProxy: reconnecting stale connection, %r', e)
+                if self.metrics is not None:
+                    self.metrics.record_reconnect()
+                conn, reused = self.pool.get(endpoint.server, endpoint.port,
+                                             self.serverssl, self.timeout)
+                continue
+            if response.will_close:
+                conn.close()
+            else:
+                self.pool.put(conn, endpoint.server, endpoint.port,
+                              self.serverssl)
+            with self._endpoint_lock:
+                if response.status == 503:
+                    endpoint.failed()
+                else:
+                    endpoint.succeeded(time.time() - start)
+            return response, respstr
+
+    def _call(self, action, resource, data, extra_headers=None):
         uri = self.base_uri + resource
         body = json.dumps(data)
         headers = {}
@@ -85,98 +736,293 @@ class RESTProxyServer(object):
         headers['X-Nuage-Organization'] = self.organization
         if self.auth:
             headers['Authorization'] = self.auth
-        conn = None
         if extra_headers:
             headers.update(extra_headers)
 
-        LOG.debug('Request uri: %s', uri)
-        LOG.debug('Request headers: %s', headers)
-        LOG.debug('Request body: %s', body)
+        debug = LOG.isEnabledFor(logging.DEBUG)
+        if debug:
+            LOG.debug('Request uri: %s', uri)
+            LOG.debug('Request headers: %s', headers)
+            LOG.debug('Request body: %s', body)
 
-        if self.serverssl:
-            if hasattr(ssl, '_create_unverified_context'):
-                # pylint: disable=no-member
-                # pylint: disable=unexpected-keyword-arg
-                conn = httplib.HTTPSConnection(
-                    self.server, self.port, timeout=self.timeout,
-                    context=ssl._create_unverified_context())
-                # pylint: enable=no-member
-                # pylint: enable=unexpected-keyword-arg
-            else:
-                conn = httplib.HTTPSConnection(
-                    self.server, self.port, timeout=self.timeout)
-            if conn is None:
-                LOG.error('RESTProxy: Could not establish HTTPS '
-                          'connection')
-                return 0, None, None, None
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.time()
+            received = retries = unavailable = 0
+        policy = self.retry_policy
+        if policy.deadline is not None:
+            deadline = time.time() + policy.deadline
         else:
-            conn = httplib.HTTPConnection(
-                self.server, self.port, timeout=self.timeout)
-            if conn is None:
-                LOG.error('RESTProxy: Could not establish HTTP '
-                          'connection')
-                return 0, None, None, None
+            deadline = None
+        # Retries done so far, per status code (None for socket errors).
+        attempts = {}
+        # Nodes that failed this request since the last retry delay.
+        tried = set()
+        while True:
+            endpoint = self._pick_endpoint(tried)
+            try:
+                response, respstr = self._send(endpoint, action, uri, body,
+                                               headers)
+            except (socket.timeout, socket.error, httplib.HTTPException) as e:
+                LOG.error('ServerProxy: %(action)s failure, %(e)r',
+                          {'action': action, 'e': e})
+                status = None
+                retry_after = None
+                error = e
+            else:
+                if debug:
+                    LOG.debug('Response status is %(st)s and reason is '
+                              '%(res)s', {'st': response.status,
+                                          'res': response.reason})
+                    LOG.debug('Response data is %s', respstr)
+                status = response.status
+                if metrics is not None:
+                    received += len(respstr)
+                    unavailable += int(status == 503)
+                if not policy.retries_allowed(status):
+                    break
+                retry_after = _parse_retry_after(
+                    response.getheader('Retry-After'))
 
-        try:
-            conn.request(action, uri, body, headers)
-            response = conn.getresponse()
-            respstr = response.read()
-            respdata = respstr
-            LOG.debug('Response status is %(st)s and reason is %(res)s',
-                      {'st': response.status,
-                       'res': response.reason})
-            LOG.debug('Response data is %s', respstr)
-            if response.status in self.success_codes:
-                try:
-                    respdata = json.loads(respstr)
-                except ValueError:
-                    # response was not JSON, ignore the exception
-                    pass
-            ret = (response.status, response.reason, respstr, respdata)
-        except (socket.timeout, socket.error) as e:
-            LOG.error('ServerProxy: %(action)s failure, %(e)r', locals())
-            # retry
-            self.retry += 1
-            return self._rest_call(action, resource, data, extra_headers)
-        conn.close()
-        if response.status == 503:
-            if self.retry_503 < MAX_RETRIES_503:
-                time.sleep(1)
-                self.retry_503 += 1
-                LOG.debug('VSD unavailable. Retrying')
-                return self._rest_call(action, resource, data,
-                                       extra_headers=extra_headers)
+            tried.add(endpoint)
+            if (action in IDEMPOTENT_METHODS and
+                    len(tried) < len(self.endpoints)):
+                LOG.debug('RESTProxy: failing over %(action)s %(uri)s '
+                          'from %(endpoint)s',
+                          {'action': action, 'uri': uri,
+                           'endpoint': endpoint})
+                if metrics is not None:
+                    retries += 1
+                continue
+            tried.clear()
+
+            attempt = attempts.get(status, 0)
+            delay = policy.delay(attempt, retry_after)
+            if attempt >= policy.retries_allowed(status):
+                LOG.error('RESTProxy: Max retries exceeded')
+            elif deadline is not None and time.time() + delay > deadline:
+                LOG.error('RESTProxy: Retry deadline exceeded')
             else:
-                LOG.debug('After 5 retries VSD is unavailable. Bailing out')
-        self.retry = 0
-        self.retry_503 = 0
-        return ret
+                attempts[status] = attempt + 1
+                LOG.debug('Retrying %(action)s %(uri)s in %(delay).2fs',
+                          {'action': action, 'uri': uri, 'delay': delay})
+                if metrics is not None:
+                    retries += 1
+                time.sleep(delay)
+                continue
+            if status is None:
+                if metrics is not None:
+                    metrics.record_call(action, resource, time.time() - start,
+                                        len(body) * (retries + 1), received,
+                                        retries, unavailable, failed=True)
+                raise RESTProxyConnectionError(
+                    'Could not reach %s: %r' % (endpoint, error))
+            LOG.debug('VSD returned %s after %d retries. Bailing out',
+                      status, attempt)
+            break
 
-    def generate_nuage_auth(self):
+        respdata = respstr
+        if response.status in self.success_codes:
+            try:
+                respdata = json.loads(respstr)
+            except ValueError:
+                # response was not JSON, ignore the exception
+                pass
+        ret = (response.status, response.reason, respstr, respdata)
+        if metrics is not None:
+            metrics.record_call(action, resource, time.time() - start,
+                                len(body) * (retries + 1), received,
+                                retries, unavailable)
+        return ret, response
+
+    def _rest_call(self, action, resource, data, extra_headers=None):
+        return self._call(action, resource, data, extra_headers)[0]
+
+    def _fetch_api_key(self):
         data = ''
         encoded_auth = base64.encodestring(self.serverauth).strip()
-        self.auth = 'Basic ' + encoded_auth
-        resp = self._rest_call('GET', self.auth_resource, data)
+        resp = self._rest_call('GET', self.auth_resource, data,
+                               extra_headers={
+                                   'Authorization': 'Basic ' + encoded_auth})
         if resp[0] in self.success_codes and resp[3][0]['APIKey']:
             respkey = resp[3][0]['APIKey']
         else:
-            if resp[0] == 0:
-                assert 0, 'Could not establish conn with REST server. Abort'
-            else:
-                assert 0, 'Could not authenticate to REST server. Abort'
+            assert 0, 'Could not authenticate to REST server. Abort'
+        # APIKeyExpiry is in milliseconds since the epoch
+        expiry = resp[3][0].get('APIKeyExpiry')
+        return respkey, expiry / 1000.0 if expiry else None
+
+    def _api_key_auth(self, apikey):
         uname = self.serverauth.split(':')[0]
-        new_uname_pass = uname + ':' + respkey
-        auth = 'Basic ' + base64.encodestring(new_uname_pass).strip()
-        self.auth = auth
+        new_uname_pass = uname + ':' + apikey
+        return 'Basic ' + base64.encodestring(new_uname_pass).strip()
 
-    def rest_call(self, action, resource, data, extra_headers=None):
-        response = self._rest_call(action, resource, data,
+    def _cached_api_key(self, key, stale_auth):
+        entry = self.credential_cache.get(key)
+        if entry is None:
+            return None
+        apikey, expiry = entry
+        refresh_at = time.time() + self.credential_cache.refresh_ahead
+        if expiry is not None and expiry < refresh_at:
+            return None
+        if self._api_key_auth(apikey) == stale_auth:
+            return None
+        return apikey
+
+    def generate_nuage_auth(self, stale_auth=None):
+        if self.credential_cache is None:
+            self.auth = self._api_key_auth(self._fetch_api_key()[0])
+            return
+        key = '%s:%s|%s|%s' % (self.server, self.port, self.organization,
+                               self.serverauth.split(':')[0])
+        apikey = self._cached_api_key(key, stale_auth)
+        if apikey is None:
+            with self.credential_cache.lock(key):
+                # Another process may have refreshed the key meanwhile
+                apikey = self._cached_api_key(key, stale_auth)
+                if apikey is None:
+                    apikey, expiry = self._fetch_api_key()
+                    self.credential_cache.put(key, apikey, expiry)
+        self.auth = self._api_key_auth(apikey)
+
+    def _reauthenticate(self, stale_auth):
+        # Concurrent calls that all saw a 401 for the same key share a
+        # single re-authentication; the others reuse its result.
+        with self._auth_lock:
+            if self.auth == stale_auth:
+                self.generate_nuage_auth(stale_auth)
+
+    def _authenticated_call(self, action, resource, data,
+                            extra_headers=None):
+        if self.auth is None and self.credential_cache is not None:
+            # Start from a cached API key rather than a 401 round trip
+            self._reauthenticate(None)
+        auth = self.auth
+        ret, response = self._call(action, resource, data,
                                    extra_headers=extra_headers)
         '''
         If at all authentication expires with VSD, re-authenticate.
         '''
-        if response[0] == 401 and response[1] == 'Unauthorized':
-            self.generate_nuage_auth()
-            return self._rest_call(action, resource, data,
-                                   extra_headers=extra_headers)
-        return response
+        if ret[0] == 401 and ret[1] == 'Unauthorized':
+            if self.metrics is not None:
+                self.metrics.record_reauthentication()
+            self._reauthenticate(auth)
+            return self._call(action, resource, data,
+                              extra_headers=extra_headers)
+        return ret, response
+
+    def _cached_get(self, resource, data, extra_headers=None):
+        key = self.cache.key(resource, extra_headers)
+        cached = self.cache.lookup(key)
+        headers = dict(extra_headers or {})
+        if cached is not None:
+            result, etag, fresh = cached
+            if fresh:
+                return result
+            headers['If-None-Match'] = etag
+        ret, response = self._authenticated_call('GET', resource, data,
+                                                 extra_headers=headers)
+        if ret[0] == 304 and cached is not None:
+            self.cache.revalidated(key)
+            return cached[0]
+        if ret[0] in self.success_codes:
+            self.cache.store(key, ret, response.getheader('ETag'))
+        return ret
+
+    def rest_call(self, action, resource, data, extra_headers=None):
+        if self.cache is not None:
+            if action == 'GET':
+                return self._cached_get(resource, data, extra_headers)
+            self.cache.invalidate(resource)
+        return self._authenticated_call(action, resource, data,
+                                        extra_headers=extra_headers)[0]
+
+    def rest_call_many(self, requests, max_workers=MAX_WORKERS):
+        """Run a batch of REST calls concurrently.
+
+        :param requests: iterable of (action, resource, data) or
+            (action, resource, data, extra_headers) tuples.
+        :param max_workers: maximum number of calls in flight.
+        :returns: a list of rest_call results, in the order of requests.
+        """
+        requests = list(requests)
+        results = [None] * len(requests)
+        errors = []
+        pending = Queue.Queue()
+        for index, request in enumerate(requests):
+            pending.put((index, request))
+
+        def worker():
+            while not errors:
+                try:
+                    index, request = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[index] = self.rest_call(*request)
+                except Exception as e:
+                    LOG.error('RESTProxy: %(request)s failed, %(e)r',
+                              {'request': request[:2], 'e': e})
+                    errors.append(e)
+
+        workers = [threading.Thread(target=worker)
+                   for _i in range(min(max_workers, len(requests)))]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        for thread in workers:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    def _get_page(self, resource, page, page_size, filter, extra_headers):
+        headers = {'X-Nuage-Page': str(page),
+                   'X-Nuage-PageSize': str(page_size)}
+        if filter:
+            headers['X-Nuage-Filter'] = filter
+        if extra_headers:
+            headers.update(extra_headers)
+        ret, response = self._authenticated_call('GET', resource, '',
+                                                 extra_headers=headers)
+        if ret[0] not in self.success_codes:
+            raise RESTProxyError(ret[2], error_code=ret[0])
+        # VSD answers an empty page with an empty body
+        objects = ret[3] if isinstance(ret[3], list) else []
+        count = response.getheader('X-Nuage-Count')
+        return objects, int(count) if count else None
+
+    def iter_collection(self, resource, page_size=PAGE_SIZE, filter=None,
+                        extra_headers=None, prefetch=True):
+        """Iterate over all objects of a VSD collection, page by page.
+
+        :param resource: the collection resource, e.g. '/enterprises'.
+        :param page_size: number of objects requested per page.
+        :param filter: optional VSD filter expression (X-Nuage-Filter).
+        :param extra_headers: additional headers sent with every page.
+        :param prefetch: fetch the next page in the background while the
+            objects of the current page are being consumed.
+        :returns: a generator yielding the objects one by one.
+        """
+        page = 0
+        objects, count = self._get_page(resource, page, page_size, filter,
+                                        extra_headers)
+        while True:
+            if count is not None:
+                more = (page + 1) * page_size < count
+            else:
+                more = len(objects) >= page_size
+            next_page = None
+            if more and prefetch:
+                next_page = _Prefetch(self._get_page, resource, page + 1,
+                                      page_size, filter, extra_headers)
+            for obj in objects:
+                yield obj
+            if not more:
+                return
+            page += 1
+            if next_page is not None:
+                objects, count = next_page.result()
+            else:
+                objects, count = self._get_page(resource, page, page_size,
+                                                filter, extra_headers)
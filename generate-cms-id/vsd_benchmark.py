@@ -0,0 +1,202 @@
+# Copyright 2015 Alcatel-Lucent USA Inc.
+# All Rights Reserved.
+
+"""Benchmarks of RESTProxyServer against the local mock VSD.
+
+Each scenario starts a MockVSD with its own faults, drives it with a
+RESTProxyServer and reports requests per second, p50/p99 call latency,
+client retries, re-authentications and reconnects, and the logins, 503s
+and resets seen by the mock VSD. The startup scenario times launches of
+configure_vsd_cms_id.py --help instead. Results are written as JSON
+tagged with the git commit so that runs can be compared across commits:
+
+    python vsd_benchmark.py --output before.json
+    git checkout <other commit>
+    python vsd_benchmark.py --compare before.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from mock_vsd import Faults
+from mock_vsd import MockVSD
+from restproxy import Metrics
+from restproxy import RESTProxyServer
+from restproxy import RetryPolicy
+
+# name: (faults, calls, concurrency, mode). In 'iter' mode, calls is the
+# number of objects listed with iter_collection, in 'startup' mode the
+# number of CLI launches.
+SCENARIOS = {
+    'sequential': (Faults(), 2000, 1, 'get'),
+    'concurrent': (Faults(latency=0.005), 2000, 16, 'get'),
+    'latency': (Faults(latency=0.02, jitter=0.01), 500, 16, 'get'),
+    'key_expiry': (Faults(api_key_lifetime=0.5), 2000, 8, 'get'),
+    'storm_503': (Faults(unavailable=0.2), 1000, 8, 'get'),
+    'resets': (Faults(reset=0.02), 1000, 8, 'get'),
+    'paginate': (Faults(latency=0.005), 20000, 1, 'iter'),
+    'startup': (None, 20, 1, 'startup'),
+}
+COLLECTION = '/vports'
+CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                   'configure_vsd_cms_id.py')
+
+
+def _percentile_ms(samples, fraction):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000
+
+
+def run_startup(calls):
+    latencies = []
+    errors = 0
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        for _i in range(calls):
+            call_start = time.time()
+            errors += int(subprocess.call([sys.executable, CLI, '--help'],
+                                          stdout=devnull) != 0)
+            latencies.append(time.time() - call_start)
+        elapsed = time.time() - start
+    # --help does not look the MAC up: report whether a default CMS name
+    # on this host comes from sysfs or from uuid.getnode(), and its cost
+    from configure_vsd_cms_id import _sysfs_mac
+    from configure_vsd_cms_id import default_cms_name
+    mac_start = time.time()
+    default_cms_name()
+    mac_ms = (time.time() - mac_start) * 1000
+    return {
+        'sysfs_mac': _sysfs_mac() is not None,
+        'mac_ms': mac_ms,
+        'calls': calls,
+        'concurrency': 1,
+        'seconds': elapsed,
+        'requests_per_second': calls / elapsed,
+        'p50_ms': _percentile_ms(latencies, 0.5),
+        'p99_ms': _percentile_ms(latencies, 0.99),
+        'errors': errors,
+    }
+
+
+def run_scenario(name, backoff_base):
+    faults, calls, concurrency, mode = SCENARIOS[name]
+    if mode == 'startup':
+        return run_startup(calls)
+    vsd = MockVSD(faults=faults, collections={COLLECTION: calls}).start()
+    metrics = Metrics()
+    client = RESTProxyServer(vsd.address, vsd.base_uri, False,
+                             '%s:%s' % (vsd.username, vsd.password),
+                             vsd.auth_resource, 'csp', metrics=metrics,
+                             retry_policy=RetryPolicy(
+                                 backoff_base=backoff_base),
+                             pool_size=concurrency)
+    client.generate_nuage_auth()
+    ids = [obj['ID'] for obj in vsd.objects[COLLECTION]]
+    latencies = []
+    errors = []
+    start = time.time()
+    if mode == 'iter':
+        count = sum(1 for _obj in client.iter_collection(COLLECTION))
+        if count != calls:
+            errors.append('iterated %d of %d objects' % (count, calls))
+    else:
+        def worker(offset):
+            samples = []
+            for index in range(offset, calls, concurrency):
+                call_start = time.time()
+                try:
+                    status = client.rest_call(
+                        'GET', '%s/%s' % (COLLECTION, ids[index]), '')[0]
+                except Exception as e:
+                    errors.append(repr(e))
+                    continue
+                samples.append(time.time() - call_start)
+                if status != 200:
+                    errors.append('status %s' % status)
+            latencies.extend(samples)
+
+        workers = [threading.Thread(target=worker, args=(offset,))
+                   for offset in range(concurrency)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+    elapsed = time.time() - start
+    client.close()
+    vsd.stop()
+
+    snapshot = metrics.snapshot()
+    return {
+        'calls': calls,
+        'concurrency': concurrency,
+        'seconds': elapsed,
+        'requests_per_second': calls / elapsed,
+        'p50_ms': _percentile_ms(latencies, 0.5),
+        'p99_ms': _percentile_ms(latencies, 0.99),
+        'errors': len(errors),
+        'retries': sum(c['retries'] for c in snapshot['calls']),
+        'reauthentications': snapshot['reauthentications'],
+        'reconnects': snapshot['reconnects'],
+        'vsd': dict(vsd.stats),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _compare(results, baseline):
+    print('%-12s %12s %12s %8s' % ('scenario', 'req/s', 'p99 ms', 'ratio'))
+    for name, result in sorted(results['scenarios'].items()):
+        before = baseline['scenarios'].get(name)
+        ratio = ''
+        if before:
+            ratio = '%.2fx' % (result['requests_per_second'] /
+                               before['requests_per_second'])
+        print('%-12s %12.1f %12s %8s' % (
+            name, result['requests_per_second'],
+            '%.1f' % result['p99_ms'] if result['p99_ms'] else '-', ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenario', action='append',
+                        choices=sorted(SCENARIOS),
+                        help='Scenario to run, all of them by default')
+    parser.add_argument('--backoff_base', type=float, default=0.05,
+                        help='RetryPolicy backoff_base used by the client')
+    parser.add_argument('--output', help='Write the results to this file')
+    parser.add_argument('--compare',
+                        help='Results file of an earlier run to compare to')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    results = {'commit': _git_commit(), 'python': sys.version.split()[0],
+               'scenarios': {}}
+    for name in args.scenario or sorted(SCENARIOS):
+        results['scenarios'][name] = run_scenario(name, args.backoff_base)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            _compare(results, json.load(f))
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
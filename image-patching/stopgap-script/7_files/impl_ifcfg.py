@@ -14,8 +14,20 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import errno
+import fnmatch
+import functools
 import glob
+import hashlib
+import heapq
+import json
 import logging
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
 
 import os_net_config
 from os_net_config import objects
@@ -24,6 +36,17 @@ from os_net_config import utils
 
 logger = logging.getLogger(__name__)
 
+MAX_WORKERS = 8
+HISTORY_DECAY = 0.3
+HISTORY_ACTIONS = ('ifdown', 'ifrename', 'ifup', 'ovs_appctl')
+_VISITING = 1
+_DONE = 2
+_IFCFG_HEADER = ("# This file is autogenerated by os-net-config\n"
+                 "DEVICE=%s\n"
+                 "ONBOOT=yes\n"
+                 "HOTPLUG=no\n"
+                 "NM_CONTROLLED=no\n")
+
 
 def ifcfg_config_path(name):
     return "/etc/sysconfig/network-scripts/ifcfg-%s" % name
@@ -46,11 +69,731 @@ def cleanup_pattern():
     return "/etc/sysconfig/network-scripts/ifcfg-*"
 
 
+def network_scripts_path():
+    return "/etc/sysconfig/network-scripts"
+
+
+def _digest(data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+class NetworkScriptsSnapshot(object):
+    """Digests of the ifcfg, route and route6 files, listed in one scan.
+
+    Missing files compare like empty ones, as with utils.diff. Paths
+    outside of the scanned directory are read when asked about.
+
+    :param root_dir: The root_dir of the net config.
+    """
+
+    prefixes = ('ifcfg-', 'route-', 'route6-')
+
+    def __init__(self, root_dir=''):
+        self.directory = root_dir + network_scripts_path()
+        self.paths = set()
+        # Files are only read when first diffed
+        self.digests = {}
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+        for name in names:
+            if not name.startswith(self.prefixes):
+                continue
+            path = self.directory + '/' + name
+            if os.path.isfile(path):
+                self.paths.add(path)
+        self._empty = _digest('')
+
+    def _scanned(self, path):
+        return os.path.dirname(path) == self.directory
+
+    def digest(self, path):
+        if not self._scanned(path):
+            return _digest(utils.get_file_data(path))
+        if path not in self.paths:
+            return self._empty
+        if path not in self.digests:
+            self.digests[path] = _digest(utils.get_file_data(path))
+        return self.digests[path]
+
+    def diff(self, path, data):
+        """Return True if path does not hold data."""
+        return self.digest(path) != _digest(data)
+
+    def glob(self, pattern):
+        if self._scanned(pattern):
+            return sorted(fnmatch.filter(self.paths, pattern))
+        return sorted(glob.glob(pattern))
+
+
+class ConfigTransaction(object):
+    """Write a batch of config files atomically.
+
+    Files are staged in a temporary directory next to their destination,
+    synced, then renamed into place. If a rename fails, the files
+    already replaced get their previous content back.
+
+    Files staged with None as their data are removed instead.
+    """
+
+    def __init__(self):
+        self.files = {}
+        # path -> seconds spent writing and syncing the file
+        self.timings = {}
+
+    def stage(self, path, data):
+        self.files[path] = data
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _write(self, tmp_dirs, path, data):
+        directory = os.path.dirname(path)
+        if directory not in tmp_dirs:
+            tmp_dirs[directory] = tempfile.mkdtemp(prefix='.os-net-config-',
+                                                   dir=directory)
+        tmp_path = os.path.join(tmp_dirs[directory], os.path.basename(path))
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+        except OSError:
+            pass
+        return tmp_path
+
+    def _fsync_dir(self, directory):
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def commit(self):
+        if not self.files:
+            return
+        tmp_dirs = {}
+        previous = {}
+        committed = []
+        try:
+            staged = []
+            for path, data in sorted(self.files.items()):
+                start = time.time()
+                tmp_path = None
+                if data is not None:
+                    tmp_path = self._write(tmp_dirs, path, data)
+                staged.append((path, tmp_path))
+                self.timings[path] = time.time() - start
+            for path, tmp_path in staged:
+                start = time.time()
+                previous[path] = self._read(path)
+                if tmp_path is None:
+                    os.remove(path)
+                else:
+                    os.rename(tmp_path, path)
+                committed.append(path)
+                self.timings[path] += time.time() - start
+            for directory in set(os.path.dirname(path)
+                                 for path in committed):
+                self._fsync_dir(directory)
+        except (IOError, OSError):
+            logger.error('Failed to write config files, rolling back %d '
+                         'of them' % len(committed))
+            self._rollback(tmp_dirs, committed, previous)
+            raise
+        finally:
+            for tmp_dir in tmp_dirs.values():
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.files = {}
+
+    def _rollback(self, tmp_dirs, committed, previous):
+        for path in reversed(committed):
+            try:
+                if previous[path] is None:
+                    os.remove(path)
+                else:
+                    os.rename(self._write(tmp_dirs, path, previous[path]),
+                              path)
+            except (IOError, OSError):
+                logger.exception('Could not restore %s' % path)
+
+
+def sys_class_net_path():
+    return "/sys/class/net"
+
+
+class NicInventory(object):
+    """MAC, operstate, MTU and master of every NIC, read in one scan.
+
+    :param root_dir: The root_dir of the net config. Only its
+        sys/class/net is read, the host's is only read without root_dir.
+    """
+
+    def __init__(self, root_dir=''):
+        self.path = root_dir + sys_class_net_path()
+        self.nics = {}
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            names = []
+        for name in names:
+            self.nics[name] = self._read_nic(name)
+
+    def _read(self, name, attribute):
+        try:
+            with open(os.path.join(self.path, name, attribute)) as f:
+                return f.read().rstrip()
+        except IOError:
+            return None
+
+    def _read_nic(self, name):
+        try:
+            mtu = int(self._read(name, 'mtu'))
+        except (TypeError, ValueError):
+            mtu = None
+        try:
+            master = os.path.basename(
+                os.readlink(os.path.join(self.path, name, 'master')))
+        except OSError:
+            master = None
+        return {'address': self._read(name, 'address'),
+                'operstate': self._read(name, 'operstate'),
+                'mtu': mtu,
+                'master': master}
+
+    def get(self, name):
+        return self.nics.get(name)
+
+    def mac(self, name):
+        nic = self.nics.get(name)
+        if not nic or not nic['address']:
+            logger.error("Unable to read mac address: %s" % name)
+            raise IOError(errno.ENOENT, 'No such NIC',
+                          os.path.join(self.path, name))
+        return nic['address']
+
+
+def settings_path():
+    return "/etc/os-net-config/ifcfg-provider.json"
+
+
+def read_settings(root_dir=''):
+    """Return the settings of IfcfgNetConfig from settings_path().
+
+    os-net-config only passes noop and root_dir to the provider, so the
+    options it has beyond them are read from this JSON file, under
+    root_dir, when they are not passed to the constructor. For example,
+    to keep an apply journal and write a timing report of every run:
+
+        {"incremental": true,
+         "report_path": "/var/log/os-net-config-timings.json"}
+
+    A missing file means the default settings.
+    """
+    path = root_dir + settings_path()
+    try:
+        with open(path) as f:
+            settings = json.load(f)
+    except IOError:
+        return {}
+    except ValueError:
+        logger.warning('Ignoring unreadable settings %s' % path)
+        return {}
+    if not isinstance(settings, dict):
+        logger.warning('Ignoring settings %s, not a JSON object' % path)
+        return {}
+    return settings
+
+
+def journal_path():
+    return "/var/lib/os-net-config/ifcfg-journal.json"
+
+
+def timings_path():
+    return "/var/lib/os-net-config/ifcfg-timings.json"
+
+
+class TimingHistory(object):
+    """Moving averages of past ifdown/ifup/ifrename/ovs-appctl timings.
+
+    :param path: The file the history is kept in.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # action -> device -> seconds, and phase -> seconds
+        self.devices = {}
+        self.phases = {}
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            self.devices = state['devices']
+            self.phases = state['phases']
+        except IOError:
+            pass
+        except (ValueError, KeyError, TypeError):
+            logger.warning('Ignoring unreadable timing history %s' % path)
+
+    @staticmethod
+    def _average(old, sample):
+        if old is None:
+            return sample
+        return old * (1 - HISTORY_DECAY) + sample * HISTORY_DECAY
+
+    def update(self, device_timings, phase_timings):
+        for action in HISTORY_ACTIONS:
+            history = self.devices.setdefault(action, {})
+            for name, seconds in device_timings.get(action, {}).items():
+                history[name] = self._average(history.get(name), seconds)
+        for phase, seconds in phase_timings.items():
+            self.phases[phase] = self._average(self.phases.get(phase),
+                                               seconds)
+
+    def duration(self, action, name):
+        """Return the expected seconds of an action on a device.
+
+        Devices never seen before are expected to take the average of
+        the others, or None if there is no history at all.
+        """
+        history = self.devices.get(action)
+        if not history:
+            return None
+        if name in history:
+            return history[name]
+        return sum(history.values()) / len(history)
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'devices': self.devices, 'phases': self.phases}, f,
+                      sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+
+def _canonical(value):
+    """Return a JSON serializable form of an object model value."""
+    if isinstance(value, dict):
+        return dict((str(key), _canonical(item))
+                    for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    if value is None or isinstance(value, (bool, int, long, float,
+                                           basestring)):
+        return value
+    if hasattr(value, '__dict__'):
+        state = _canonical(vars(value))
+        state['__class__'] = type(value).__name__
+        return state
+    return str(value)
+
+
+class ApplyJournal(object):
+    """What the last apply() wrote, kept between os-net-config runs.
+
+    For each device the journal holds a digest of its inputs and the
+    digest, size and mtime of its ifcfg, route and route6 files, along
+    with the edges of the device graph.
+
+    :param path: The journal file.
+    """
+
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.devices = {}
+        self.edges = {}
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except IOError:
+            return
+        except ValueError:
+            logger.warning('Ignoring unreadable journal %s' % path)
+            return
+        if state.get('version') == self.version:
+            self.devices = state['devices']
+            self.edges = state['edges']
+
+    def unchanged(self, name, inputs):
+        """Return True if device name still has the files it was given.
+
+        :param name: The name of the device.
+        :param inputs: The digest of the inputs of the device.
+        """
+        entry = self.devices.get(name)
+        if not entry or entry['inputs'] != inputs:
+            return False
+        for path, (digest, size, mtime) in entry['files'].items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                # empty files are not written
+                if digest != _digest(''):
+                    return False
+                continue
+            if (st.st_size, st.st_mtime) != (size, mtime):
+                # touched, compare the content
+                if _digest(utils.get_file_data(path)) != digest:
+                    return False
+                entry['files'][path] = [digest, st.st_size, st.st_mtime]
+        return True
+
+    def record(self, name, inputs, files):
+        """Record the files written for a device.
+
+        :param files: A list of (path, data) tuples.
+        """
+        entry = {'inputs': inputs, 'files': {}}
+        for path, data in files:
+            try:
+                st = os.stat(path)
+            except OSError:
+                entry['files'][path] = [_digest(data), None, None]
+            else:
+                entry['files'][path] = [_digest(data), st.st_size,
+                                        st.st_mtime]
+        self.devices[name] = entry
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        state = {'version': self.version, 'devices': self.devices,
+                 'edges': self.edges}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+
+class DeviceGraph(object):
+    """Dependency graph of the devices added to a net config object.
+
+    Edges go from a bridge or bond to its members, and from a device to
+    the VLANs stacked on it. Transitive member sets and the topological
+    order are computed once and cached until the graph changes.
+    """
+
+    def __init__(self):
+        self.devices = []
+        self.members = {}
+        self.lower = {}
+        self._device_set = set()
+        self._closures = {}
+        self._successors = None
+        self._order = None
+        self._position = None
+
+    def __contains__(self, name):
+        return name in self._device_set
+
+    def _invalidate(self):
+        self._closures = {}
+        self._successors = None
+        self._order = None
+        self._position = None
+
+    def add_device(self, name):
+        if name not in self._device_set:
+            self._device_set.add(name)
+            self.devices.append(name)
+            self._order = None
+            self._position = None
+
+    def set_members(self, name, members):
+        self.add_device(name)
+        self.members[name] = list(members)
+        self._invalidate()
+
+    def set_lower(self, name, lower):
+        """Record that device name is stacked on device lower."""
+        self.add_device(name)
+        self.lower[name] = lower
+        self._invalidate()
+
+    def successors(self):
+        """Return a dict of device to the devices that depend on it."""
+        if self._successors is None:
+            successors = dict((name, list(members)) for name, members
+                              in self.members.items())
+            for name, lower in self.lower.items():
+                successors.setdefault(lower, []).append(name)
+            self._successors = successors
+        return self._successors
+
+    def dependencies(self, names):
+        """Return the ordering constraints between a subset of devices.
+
+        :param names: The devices being acted upon.
+        :returns: a dict of each of names to the set of names that must
+            be up before it. Devices outside of names are looked through,
+            so a VLAN still follows the bridge above an unchanged bond.
+        """
+        predecessors = {}
+        for name, successors in self.successors().items():
+            for successor in successors:
+                predecessors.setdefault(successor, []).append(name)
+        names = set(names)
+        result = {}
+        for name in names:
+            found = set()
+            seen = set([name])
+            pending = list(predecessors.get(name, []))
+            while pending:
+                current = pending.pop()
+                if current in seen:
+                    continue
+                seen.add(current)
+                if current in names:
+                    found.add(current)
+                else:
+                    pending.extend(predecessors.get(current, []))
+            result[name] = found
+        return result
+
+    def child_members(self, name, _path=()):
+        """Return the transitive members of a device.
+
+        A device without members is its own only child, which lets callers
+        restart either the device or everything below it alike.
+
+        :param name: The name of the device.
+        :raises: InvalidConfigException if the members form a cycle.
+        """
+        try:
+            return self._closures[name]
+        except KeyError:
+            pass
+        if name not in self.members:
+            return frozenset([name])
+        if name in _path:
+            raise objects.InvalidConfigException(
+                'Device %s is a member of itself: %s' %
+                (name, ' -> '.join(_path + (name,))))
+        children = set()
+        for member in self.members[name]:
+            children.add(member)
+            children.update(self.child_members(member, _path + (name,)))
+        self._closures[name] = frozenset(children)
+        return self._closures[name]
+
+    def topological_order(self):
+        """Return all devices, each one before the devices depending on it.
+
+        Devices that do not depend on each other keep the order in which
+        they were added.
+
+        :raises: InvalidConfigException if the members form a cycle.
+        """
+        if self._order is None:
+            # Reverse post-order of a depth first walk along member edges.
+            # The roots are walked backwards so that the reversed result
+            # keeps the insertion order.
+            successors = self.successors()
+            order = []
+            state = {}
+            for root in reversed(self.devices):
+                if root in state:
+                    continue
+                state[root] = _VISITING
+                stack = [(root, reversed(successors.get(root, [])))]
+                while stack:
+                    name, pending = stack[-1]
+                    for member in pending:
+                        if state.get(member) == _VISITING:
+                            raise objects.InvalidConfigException(
+                                'Device %s is a member of itself' % member)
+                        if member not in state:
+                            state[member] = _VISITING
+                            stack.append(
+                                (member,
+                                 reversed(successors.get(member, []))))
+                            break
+                    else:
+                        stack.pop()
+                        state[name] = _DONE
+                        order.append(name)
+            order.reverse()
+            self._order = order
+        return list(self._order)
+
+    def ordered(self, names):
+        """Deduplicate names and sort them by topological order.
+
+        Names unknown to the graph go last, in their original order.
+        """
+        if self._position is None:
+            self._position = dict((name, index) for index, name
+                                  in enumerate(self.topological_order()))
+        position = self._position
+        unique = []
+        seen = set()
+        for name in names:
+            if name not in seen:
+                seen.add(name)
+                unique.append(name)
+        last = len(position)
+        return sorted(unique, key=lambda name: position.get(name, last))
+
+
+class DeviceScheduler(object):
+    """Run device actions concurrently, in dependency order.
+
+    :param max_workers: The maximum number of actions run at once.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.max_workers = max(1, max_workers)
+
+    def run(self, tasks):
+        """Run tasks and return how long each one took.
+
+        :param tasks: A list of (key, dependencies, function) tuples. A
+            task starts once the tasks named in its dependencies are done,
+            dependencies which are not keys of tasks are ignored. Ready
+            tasks are started in list order.
+        :returns: a dict of task key to seconds.
+        :raises: the first exception raised by a task. No task is started
+            after a failure, the running ones are waited for.
+        """
+        position = {}
+        functions = {}
+        for index, (key, _dependencies, function) in enumerate(tasks):
+            position[key] = index
+            functions[key] = function
+        waiting = {}
+        dependents = {}
+        for key, dependencies, _function in tasks:
+            dependencies = set(dep for dep in dependencies
+                               if dep in position and dep != key)
+            waiting[key] = len(dependencies)
+            for dep in dependencies:
+                dependents.setdefault(dep, []).append(key)
+        ready = [(position[key], key) for key in waiting if not waiting[key]]
+        heapq.heapify(ready)
+        timings = {}
+        errors = []
+        running = [0]
+        condition = threading.Condition()
+
+        def worker():
+            while True:
+                with condition:
+                    while not (ready and not errors):
+                        if not running[0]:
+                            return
+                        condition.wait()
+                    key = heapq.heappop(ready)[1]
+                    running[0] += 1
+                start = time.time()
+                error = None
+                try:
+                    functions[key]()
+                except Exception as e:
+                    error = e
+                with condition:
+                    running[0] -= 1
+                    timings[key] = time.time() - start
+                    if error is not None:
+                        errors.append(error)
+                    else:
+                        for dependent in dependents.get(key, []):
+                            waiting[dependent] -= 1
+                            if not waiting[dependent]:
+                                heapq.heappush(
+                                    ready, (position[dependent], dependent))
+                    condition.notify_all()
+
+        threads = [threading.Thread(target=worker) for _i in
+                   range(min(self.max_workers, len(tasks)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        if len(timings) < len(tasks):
+            raise objects.InvalidConfigException(
+                'Circular dependency between %s' %
+                ', '.join(str(key) for key in position
+                          if key not in timings))
+        return timings
+
+    def estimate(self, tasks, duration):
+        """Return how long run(tasks) would take.
+
+        :param tasks: The tasks, as for run().
+        :param duration: A function of a task key to its seconds.
+        """
+        position = dict((key, index) for index, (key, _dependencies,
+                                                 _function)
+                        in enumerate(tasks))
+        waiting = {}
+        dependents = {}
+        for key, dependencies, _function in tasks:
+            dependencies = set(dep for dep in dependencies
+                               if dep in position and dep != key)
+            waiting[key] = len(dependencies)
+            for dep in dependencies:
+                dependents.setdefault(dep, []).append(key)
+        ready = [(position[key], key) for key in waiting if not waiting[key]]
+        heapq.heapify(ready)
+        # (finish time, key) of the running tasks
+        running = []
+        now = 0.0
+        while ready or running:
+            while ready and len(running) < self.max_workers:
+                key = heapq.heappop(ready)[1]
+                heapq.heappush(running, (now + duration(key), key))
+            now, key = heapq.heappop(running)
+            for dependent in dependents.get(key, []):
+                waiting[dependent] -= 1
+                if not waiting[dependent]:
+                    heapq.heappush(ready, (position[dependent], dependent))
+        return now
+
+
 class IfcfgNetConfig(os_net_config.NetConfig):
-    """Configure network interfaces using the ifcfg format."""
+    """Configure network interfaces using the ifcfg format.
+
+    Devices are brought down and up concurrently by up to max_workers
+    ifdown/ifup processes, in dependency order.
+
+    In incremental mode a journal of the last apply() is kept and only
+    the devices whose inputs or files changed since are rendered and
+    diffed. os-net-config does not pass incremental, it is read from
+    read_settings() then.
+
+    Phase and per device timings are always recorded. With report_path,
+    apply() also writes them as a JSON report and keeps a history of
+    them, from which the outage of a noop run is estimated. Like
+    incremental, report_path is read from read_settings() when it is not
+    passed.
+    """
 
-    def __init__(self, noop=False, root_dir=''):
+    def __init__(self, noop=False, root_dir='', max_workers=MAX_WORKERS,
+                 incremental=None, report_path=None):
         super(IfcfgNetConfig, self).__init__(noop, root_dir)
+        settings = read_settings(root_dir)
+        if incremental is None:
+            incremental = bool(settings.get('incremental'))
+        if report_path is None:
+            report_path = settings.get('report_path')
         self.interface_data = {}
         self.vlan_data = {}
         self.route_data = {}
@@ -58,182 +801,317 @@ class IfcfgNetConfig(os_net_config.NetConfig):
         self.bridge_data = {}
         self.linuxbridge_data = {}
         self.linuxbond_data = {}
-        self.member_names = {}
+        self.device_graph = DeviceGraph()
         self.bond_slaves = {}
         self.renamed_interfaces = {}
         self.bond_primary_ifaces = {}
+        self.scheduler = DeviceScheduler(max_workers)
+        # action -> device -> seconds and phase -> seconds
+        self.device_timings = {}
+        self.phase_timings = {}
+        self.report_path = report_path
+        self.history = None
+        if report_path:
+            self.history = TimingHistory(root_dir + timings_path())
+        self.estimated_timings = {}
+        self.journal = None
+        if incremental:
+            self.journal = ApplyJournal(root_dir + journal_path())
+        self.unchanged_devices = set()
+        self._inputs = {}
+        self.nic_inventory = None
+        # when the first object was added, rendering starts there
+        self._render_start = None
         logger.info('Ifcfg net config provider created.')
 
     def child_members(self, name):
-        children = set()
-        try:
-            for member in self.member_names[name]:
-                children.add(member)
-                children.update(self.child_members(member))
-        except KeyError:
-            children.add(name)
-        return children
+        return self.device_graph.child_members(name)
 
-    def _add_common(self, base_opt):
+    def interface_mac(self, name):
+        # sysfs is scanned on the first lookup and reused for the run
+        if self.nic_inventory is None:
+            self.nic_inventory = NicInventory(self.root_dir)
+        return self.nic_inventory.mac(name)
 
-        ovs_extra = []
+    def _add_timing(self, action, name, seconds):
+        timings = self.device_timings.setdefault(action, {})
+        timings[name] = timings.get(name, 0) + seconds
+
+    def _run_tasks(self, phase, tasks):
+        start = time.time()
+        timings = self.scheduler.run(tasks)
+        self.phase_timings[phase] = time.time() - start
+        for (action, name), seconds in timings.items():
+            self._add_timing(action, name, seconds)
+        if self.noop and self.history is not None:
+            self.estimated_timings[phase] = self.scheduler.estimate(
+                tasks, lambda key: self.history.duration(*key) or 0)
+
+    def _device_tasks(self, action, names, bridges, down=False):
+        """Return scheduler tasks running ifdown or ifup on devices.
 
-        data = "# This file is autogenerated by os-net-config\n"
-        data += "DEVICE=%s\n" % base_opt.name
-        data += "ONBOOT=yes\n"
-        data += "HOTPLUG=no\n"
-        data += "NM_CONTROLLED=no\n"
+        Devices go up after the devices they depend on, and down before
+        them.
+        """
+        dependencies = self.device_graph.dependencies(names)
+        if down:
+            reverse = dict((name, set()) for name in dependencies)
+            for name, predecessors in dependencies.items():
+                for predecessor in predecessors:
+                    reverse[predecessor].add(name)
+            dependencies = reverse
+        order = self.device_graph.ordered(names)
+        if down:
+            order.reverse()
+        method = getattr(self, action)
+        tasks = []
+        for name in order:
+            iftype = 'bridge' if name in bridges else 'interface'
+            tasks.append(((action, name),
+                          [(action, dep) for dep in dependencies[name]],
+                          functools.partial(method, name, iftype=iftype)))
+        return tasks
+
+    def _rename_tasks(self):
+        # A rename waits for the rename that frees its new name
+        tasks = []
+        for oldname, newname in self.renamed_interfaces.iteritems():
+            tasks.append((('ifrename', oldname), [('ifrename', newname)],
+                          functools.partial(self.ifrename, oldname,
+                                            newname)))
+        return tasks
+
+    def _register_common(self, base_opt):
+        """Record how a device relates to the others."""
+        graph = self.device_graph
+        graph.add_device(base_opt.name)
         if isinstance(base_opt, objects.Vlan):
-            if not base_opt.ovs_port:
-                # vlans on OVS bridges are internal ports (no device, etc)
-                data += "VLAN=yes\n"
-                if base_opt.device:
-                    data += "PHYSDEV=%s\n" % base_opt.device
-        if base_opt.ovs_port:
-            data += "DEVICETYPE=ovs\n"
-            if base_opt.bridge_name:
-                if isinstance(base_opt, objects.Vlan):
-                    data += "TYPE=OVSIntPort\n"
-                    data += "OVS_BRIDGE=%s\n" % base_opt.bridge_name
-                    data += "OVS_OPTIONS=\"tag=%s\"\n" % base_opt.vlan_id
-                else:
-                    data += "TYPE=OVSPort\n"
-                    data += "OVS_BRIDGE=%s\n" % base_opt.bridge_name
-        if base_opt.linux_bridge_name:
-            data += "BRIDGE=%s\n" % base_opt.linux_bridge_name
-        if isinstance(base_opt, objects.OvsBridge):
-            data += "DEVICETYPE=ovs\n"
-            data += "TYPE=OVSBridge\n"
-            if base_opt.use_dhcp:
-                data += "OVSBOOTPROTO=dhcp\n"
+            if not base_opt.ovs_port and base_opt.device:
+                graph.set_lower(base_opt.name, base_opt.device)
+        elif isinstance(base_opt, (objects.OvsBridge, objects.OvsBond,
+                                   objects.LinuxBridge, objects.LinuxBond)):
             if base_opt.members:
                 members = [member.name for member in base_opt.members]
-                self.member_names[base_opt.name] = members
-                if base_opt.use_dhcp:
-                    data += ("OVSDHCPINTERFACES=\"%s\"\n" % " ".join(members))
-            if base_opt.primary_interface_name:
-                mac = utils.interface_mac(base_opt.primary_interface_name)
-                ovs_extra.append("set bridge %s other-config:hwaddr=%s" %
-                                 (base_opt.name, mac))
-            if base_opt.ovs_options:
-                data += "OVS_OPTIONS=\"%s\"\n" % base_opt.ovs_options
-            ovs_extra.extend(base_opt.ovs_extra)
-        elif isinstance(base_opt, objects.OvsBond):
-            if base_opt.primary_interface_name:
+                graph.set_members(base_opt.name, members)
+                if isinstance(base_opt, objects.LinuxBond):
+                    for member in members:
+                        self.bond_slaves[member] = base_opt.name
+            if (isinstance(base_opt, objects.OvsBond) and
+                    base_opt.primary_interface_name):
                 primary_name = base_opt.primary_interface_name
                 self.bond_primary_ifaces[base_opt.name] = primary_name
-            data += "DEVICETYPE=ovs\n"
-            data += "TYPE=OVSBond\n"
-            if base_opt.use_dhcp:
-                data += "OVSBOOTPROTO=dhcp\n"
-            if base_opt.members:
-                members = [member.name for member in base_opt.members]
-                self.member_names[base_opt.name] = members
-                data += ("BOND_IFACES=\"%s\"\n" % " ".join(members))
-            if base_opt.ovs_options:
-                data += "OVS_OPTIONS=\"%s\"\n" % base_opt.ovs_options
-            ovs_extra.extend(base_opt.ovs_extra)
-        elif isinstance(base_opt, objects.LinuxBridge):
-            data += "TYPE=Bridge\n"
-            data += "DELAY=0\n"
-            if base_opt.use_dhcp:
-                data += "BOOTPROTO=dhcp\n"
-            if base_opt.members:
-                members = [member.name for member in base_opt.members]
-                self.member_names[base_opt.name] = members
-            if base_opt.primary_interface_name:
-                primary_name = base_opt.primary_interface_name
-                primary_mac = utils.interface_mac(primary_name)
-                data += "MACADDR=\"%s\"\n" % primary_mac
-        elif isinstance(base_opt, objects.LinuxBond):
-            if base_opt.primary_interface_name:
-                primary_name = base_opt.primary_interface_name
-                primary_mac = utils.interface_mac(primary_name)
-                data += "MACADDR=\"%s\"\n" % primary_mac
-            if base_opt.use_dhcp:
-                data += "BOOTPROTO=dhcp\n"
-            if base_opt.members:
-                members = [member.name for member in base_opt.members]
-                self.member_names[base_opt.name] = members
-                for member in members:
-                    self.bond_slaves[member] = base_opt.name
-            if base_opt.bonding_options:
-                data += "BONDING_OPTS=\"%s\"\n" % base_opt.bonding_options
-        else:
-            if base_opt.name in self.bond_slaves:
-                data += "MASTER=%s\n" % self.bond_slaves[base_opt.name]
-                data += "SLAVE=yes\n"
-            if base_opt.use_dhcp:
-                data += "BOOTPROTO=dhcp\n"
-            elif not base_opt.addresses:
-                data += "BOOTPROTO=none\n"
-        if base_opt.mtu != 1500:
-            data += "MTU=%i\n" % base_opt.mtu
-        if base_opt.use_dhcpv6 or base_opt.v6_addresses():
-            data += "IPV6INIT=yes\n"
-            if base_opt.mtu != 1500:
-                data += "IPV6_MTU=%i\n" % base_opt.mtu
+
+    def _device_inputs(self, base_opt):
+        """Return a digest of everything the files of a device depend on."""
+        inputs = {'object': _canonical(base_opt),
+                  'master': self.bond_slaves.get(base_opt.name)}
+        if (isinstance(base_opt, (objects.OvsBridge, objects.LinuxBridge,
+                                  objects.LinuxBond)) and
+                base_opt.primary_interface_name):
+            inputs['mac'] = self.interface_mac(
+                base_opt.primary_interface_name)
+        return _digest(json.dumps(inputs, sort_keys=True))
+
+    def _unchanged(self, base_opt):
+        if self.journal is None:
+            return False
+        name = base_opt.name
+        self._inputs[name] = self._device_inputs(base_opt)
+        if self.journal.unchanged(name, self._inputs[name]):
+            logger.info('%s is unchanged since the last run' % name)
+            self.unchanged_devices.add(name)
+            return True
+        self.unchanged_devices.discard(name)
+        return False
+
+    def _add_common(self, base_opt):
+        """Return the ifcfg data of a device.
+
+        In incremental mode, return None if the device is unchanged.
+        """
+        if self._render_start is None:
+            self._render_start = time.time()
+        self._register_common(base_opt)
+        if self.journal is not None and self._unchanged(base_opt):
+            return None
+        return self._render(base_opt)
+
+    def _render(self, base_opt):
+        renderer = _RENDERERS.get(type(base_opt))
+        if renderer is None:
+            renderer = _renderer(type(base_opt))
+        lines = [_IFCFG_HEADER % base_opt.name]
+        ovs_extra = renderer(self, base_opt, lines)
+        # the addressing is common to all the types
+        mtu = base_opt.mtu
+        if mtu != 1500:
+            lines.append('MTU=%i\n' % mtu)
+        v6_addresses = base_opt.v6_addresses()
+        if base_opt.use_dhcpv6 or v6_addresses:
+            if mtu != 1500:
+                lines.append('IPV6INIT=yes\nIPV6_MTU=%i\n' % mtu)
+            else:
+                lines.append('IPV6INIT=yes\n')
         if base_opt.use_dhcpv6:
-            data += "DHCPV6C=yes\n"
+            lines.append('DHCPV6C=yes\n')
         elif base_opt.addresses:
             #TODO(dprince): Do we want to support multiple addresses?
             v4_addresses = base_opt.v4_addresses()
             if v4_addresses:
                 first_v4 = v4_addresses[0]
-                data += "BOOTPROTO=static\n"
-                data += "IPADDR=%s\n" % first_v4.ip
-                data += "NETMASK=%s\n" % first_v4.netmask
-
-            v6_addresses = base_opt.v6_addresses()
+                lines.append('BOOTPROTO=static\nIPADDR=%s\nNETMASK=%s\n' %
+                             (first_v4.ip, first_v4.netmask))
             if v6_addresses:
-                first_v6 = v6_addresses[0]
-                data += "IPV6_AUTOCONF=no\n"
-                data += "IPV6ADDR=%s\n" % first_v6.ip
+                lines.append('IPV6_AUTOCONF=no\nIPV6ADDR=%s\n' %
+                             v6_addresses[0].ip)
         if base_opt.hwaddr:
-            data += "HWADDR=%s\n" % base_opt.hwaddr
+            lines.append('HWADDR=%s\n' % base_opt.hwaddr)
         if ovs_extra:
-            data += "OVS_EXTRA=\"%s\"\n" % " -- ".join(ovs_extra)
+            lines.append('OVS_EXTRA="%s"\n' % " -- ".join(ovs_extra))
         if not base_opt.defroute:
-            data += "DEFROUTE=no\n"
+            lines.append('DEFROUTE=no\n')
         if base_opt.dhclient_args:
-            data += "DHCLIENTARGS=%s\n" % base_opt.dhclient_args
-        if base_opt.dns_servers:
-            data += "DNS1=%s\n" % base_opt.dns_servers[0]
-            if len(base_opt.dns_servers) == 2:
-                data += "DNS2=%s\n" % base_opt.dns_servers[1]
-            elif len(base_opt.dns_servers) > 2:
+            lines.append('DHCLIENTARGS=%s\n' % base_opt.dhclient_args)
+        dns_servers = base_opt.dns_servers
+        if dns_servers:
+            lines.append('DNS1=%s\n' % dns_servers[0])
+            if len(dns_servers) == 2:
+                lines.append('DNS2=%s\n' % dns_servers[1])
+            elif len(dns_servers) > 2:
                 logger.warning('ifcfg format supports a max of 2 dns servers.')
-        return data
+        return ''.join(lines)
+
+    # The renderers below add the type specific lines of a device and
+    # return the commands of its OVS_EXTRA line.
+
+    def _render_port(self, base_opt, lines):
+        if base_opt.ovs_port:
+            if base_opt.bridge_name:
+                lines.append('DEVICETYPE=ovs\nTYPE=OVSPort\nOVS_BRIDGE=%s\n' %
+                             base_opt.bridge_name)
+            else:
+                lines.append('DEVICETYPE=ovs\n')
+        if base_opt.linux_bridge_name:
+            lines.append('BRIDGE=%s\n' % base_opt.linux_bridge_name)
+
+    def _render_slave(self, base_opt, lines):
+        master = self.bond_slaves.get(base_opt.name)
+        if master is not None:
+            lines.append('MASTER=%s\nSLAVE=yes\n' % master)
+        if base_opt.use_dhcp:
+            lines.append('BOOTPROTO=dhcp\n')
+        elif not base_opt.addresses:
+            lines.append('BOOTPROTO=none\n')
+
+    def _render_interface(self, base_opt, lines):
+        self._render_port(base_opt, lines)
+        self._render_slave(base_opt, lines)
+        return ()
+
+    def _render_vlan(self, base_opt, lines):
+        # vlans are the bulk of the big configs, so their port and slave
+        # lines are not left to _render_port and _render_slave
+        if base_opt.ovs_port:
+            # vlans on OVS bridges are internal ports (no device, etc)
+            if base_opt.bridge_name:
+                lines.append('DEVICETYPE=ovs\nTYPE=OVSIntPort\n'
+                             'OVS_BRIDGE=%s\nOVS_OPTIONS="tag=%s"\n' %
+                             (base_opt.bridge_name, base_opt.vlan_id))
+            else:
+                lines.append('DEVICETYPE=ovs\n')
+        elif base_opt.device:
+            lines.append('VLAN=yes\nPHYSDEV=%s\n' % base_opt.device)
+        else:
+            lines.append('VLAN=yes\n')
+        if base_opt.linux_bridge_name:
+            lines.append('BRIDGE=%s\n' % base_opt.linux_bridge_name)
+        master = self.bond_slaves.get(base_opt.name)
+        if master is not None:
+            lines.append('MASTER=%s\nSLAVE=yes\n' % master)
+        if base_opt.use_dhcp:
+            lines.append('BOOTPROTO=dhcp\n')
+        elif not base_opt.addresses:
+            lines.append('BOOTPROTO=none\n')
+        return ()
+
+    def _render_ovs_bridge(self, base_opt, lines):
+        self._render_port(base_opt, lines)
+        lines.append('DEVICETYPE=ovs\nTYPE=OVSBridge\n')
+        ovs_extra = []
+        if base_opt.use_dhcp:
+            lines.append('OVSBOOTPROTO=dhcp\n')
+            if base_opt.members:
+                members = [member.name for member in base_opt.members]
+                lines.append('OVSDHCPINTERFACES="%s"\n' % " ".join(members))
+        if base_opt.primary_interface_name:
+            mac = self.interface_mac(base_opt.primary_interface_name)
+            ovs_extra.append("set bridge %s other-config:hwaddr=%s" %
+                             (base_opt.name, mac))
+        if base_opt.ovs_options:
+            lines.append('OVS_OPTIONS="%s"\n' % base_opt.ovs_options)
+        ovs_extra.extend(base_opt.ovs_extra)
+        return ovs_extra
+
+    def _render_ovs_bond(self, base_opt, lines):
+        self._render_port(base_opt, lines)
+        lines.append('DEVICETYPE=ovs\nTYPE=OVSBond\n')
+        if base_opt.use_dhcp:
+            lines.append('OVSBOOTPROTO=dhcp\n')
+        if base_opt.members:
+            members = [member.name for member in base_opt.members]
+            lines.append('BOND_IFACES="%s"\n' % " ".join(members))
+        if base_opt.ovs_options:
+            lines.append('OVS_OPTIONS="%s"\n' % base_opt.ovs_options)
+        return base_opt.ovs_extra
+
+    def _render_linux_bridge(self, base_opt, lines):
+        self._render_port(base_opt, lines)
+        lines.append('TYPE=Bridge\nDELAY=0\n')
+        if base_opt.use_dhcp:
+            lines.append('BOOTPROTO=dhcp\n')
+        if base_opt.primary_interface_name:
+            primary_mac = self.interface_mac(base_opt.primary_interface_name)
+            lines.append('MACADDR="%s"\n' % primary_mac)
+        return ()
+
+    def _render_linux_bond(self, base_opt, lines):
+        self._render_port(base_opt, lines)
+        if base_opt.primary_interface_name:
+            primary_mac = self.interface_mac(base_opt.primary_interface_name)
+            lines.append('MACADDR="%s"\n' % primary_mac)
+        if base_opt.use_dhcp:
+            lines.append('BOOTPROTO=dhcp\n')
+        if base_opt.bonding_options:
+            lines.append('BONDING_OPTS="%s"\n' % base_opt.bonding_options)
+        return ()
 
     def _add_routes(self, interface_name, routes=[]):
+        if interface_name in self.unchanged_devices:
+            # the journal already has its route files
+            return
         logger.info('adding custom route for interface: %s' % interface_name)
+        # every line ends the same way, format it once
+        dev = " dev %s\n" % interface_name
         data = ""
         first_line = ""
         data6 = ""
         first_line6 = ""
         for route in routes:
-            if ":" not in route.next_hop:
-                # Route is an IPv4 route
-                if route.default:
-                    first_line = "default via %s dev %s\n" % (route.next_hop,
-                                                              interface_name)
+            next_hop = route.next_hop
+            if route.default:
+                if ":" in next_hop:
+                    first_line6 = "default via " + next_hop + dev
                 else:
-                    data += "%s via %s dev %s\n" % (route.ip_netmask,
-                                                    route.next_hop,
-                                                    interface_name)
-            else:
+                    first_line = "default via " + next_hop + dev
+            elif ":" in next_hop:
                 # Route is an IPv6 route
-                if route.default:
-                    first_line6 = "default via %s dev %s\n" % (route.next_hop,
-                                                               interface_name)
-                else:
-                    data6 += "%s via %s dev %s\n" % (route.ip_netmask,
-                                                     route.next_hop,
-                                                     interface_name)
+                data6 += route.ip_netmask + " via " + next_hop + dev
+            else:
+                data += route.ip_netmask + " via " + next_hop + dev
         self.route_data[interface_name] = first_line + data
         self.route6_data[interface_name] = first_line6 + data6
-        logger.debug('route data: %s' % self.route_data[interface_name])
-        logger.debug('ipv6 route data: %s' % self.route6_data[interface_name])
+        logger.debug('route data: %s', self.route_data[interface_name])
+        logger.debug('ipv6 route data: %s', self.route6_data[interface_name])
 
     def add_interface(self, interface):
         """Add an Interface object to the net config object.
@@ -242,7 +1120,7 @@ class IfcfgNetConfig(os_net_config.NetConfig):
         """
         logger.info('adding interface: %s' % interface.name)
         data = self._add_common(interface)
-        logger.debug('interface data: %s' % data)
+        logger.debug('interface data: %s', data)
         self.interface_data[interface.name] = data
         if interface.routes:
             self._add_routes(interface.name, interface.routes)
@@ -259,7 +1137,7 @@ class IfcfgNetConfig(os_net_config.NetConfig):
         """
         logger.info('adding vlan: %s' % vlan.name)
         data = self._add_common(vlan)
-        logger.debug('vlan data: %s' % data)
+        logger.debug('vlan data: %s', data)
         self.vlan_data[vlan.name] = data
         if vlan.routes:
             self._add_routes(vlan.name, vlan.routes)
@@ -271,7 +1149,7 @@ class IfcfgNetConfig(os_net_config.NetConfig):
         """
         logger.info('adding bridge: %s' % bridge.name)
         data = self._add_common(bridge)
-        logger.debug('bridge data: %s' % data)
+        logger.debug('bridge data: %s', data)
         self.bridge_data[bridge.name] = data
         if bridge.routes:
             self._add_routes(bridge.name, bridge.routes)
@@ -283,7 +1161,7 @@ class IfcfgNetConfig(os_net_config.NetConfig):
         """
         logger.info('adding linux bridge: %s' % bridge.name)
         data = self._add_common(bridge)
-        logger.debug('bridge data: %s' % data)
+        logger.debug('bridge data: %s', data)
         self.linuxbridge_data[bridge.name] = data
         if bridge.routes:
             self._add_routes(bridge.name, bridge.routes)
@@ -295,7 +1173,7 @@ class IfcfgNetConfig(os_net_config.NetConfig):
         """
         logger.info('adding bond: %s' % bond.name)
         data = self._add_common(bond)
-        logger.debug('bond data: %s' % data)
+        logger.debug('bond data: %s', data)
         self.interface_data[bond.name] = data
         if bond.routes:
             self._add_routes(bond.name, bond.routes)
@@ -307,7 +1185,7 @@ class IfcfgNetConfig(os_net_config.NetConfig):
         """
         logger.info('adding linux bond: %s' % bond.name)
         data = self._add_common(bond)
-        logger.debug('bond data: %s' % data)
+        logger.debug('bond data: %s', data)
         self.interface_data[bond.name] = data
         self.linuxbond_data[bond.name] = data
         if bond.routes:
@@ -329,161 +1207,244 @@ class IfcfgNetConfig(os_net_config.NetConfig):
         Note the noop mode is set via the constructor noop boolean
         """
         logger.info('applying network configs...')
+        start = time.time()
+        # rendering happened as the objects were added, it is timed as a
+        # whole to keep the timing out of the per object code
+        self.device_timings = {}
+        self.phase_timings = {'render': start - (self._render_start or
+                                                 start)}
+        self._render_start = None
+        self.estimated_timings = {}
+        snapshot = NetworkScriptsSnapshot(self.root_dir)
+        if self._journal_unchanged(snapshot, cleanup):
+            logger.info('No changes required since the last run')
+            self.phase_timings['diff'] = time.time() - start
+            self._finish_report()
+            return {}
         restart_vlans = []
         restart_linux_bonds = []
         restart_interfaces = []
         restart_bridges = []
         update_files = {}
-        all_file_names = []
-
-        for interface_name, iface_data in self.interface_data.iteritems():
-            route_data = self.route_data.get(interface_name, '')
-            route6_data = self.route6_data.get(interface_name, '')
-            interface_path = self.root_dir + ifcfg_config_path(interface_name)
-            route_path = self.root_dir + route_config_path(interface_name)
-            route6_path = self.root_dir + route6_config_path(interface_name)
-            all_file_names.append(interface_path)
-            all_file_names.append(route_path)
-            all_file_names.append(route6_path)
-            if (utils.diff(interface_path, iface_data) or
-                utils.diff(route_path, route_data) or
-                utils.diff(route6_path, route6_data)):
-                restart_interfaces.append(interface_name)
-                restart_interfaces.extend(self.child_members(interface_name))
-                update_files[interface_path] = iface_data
-                update_files[route_path] = route_data
-                update_files[route6_path] = route6_data
-            else:
-                logger.info('No changes required for interface: %s' %
-                            interface_name)
-
-        for vlan_name, vlan_data in self.vlan_data.iteritems():
-            route_data = self.route_data.get(vlan_name, '')
-            route6_data = self.route6_data.get(vlan_name, '')
-            vlan_path = self.root_dir + ifcfg_config_path(vlan_name)
-            vlan_route_path = self.root_dir + route_config_path(vlan_name)
-            vlan_route6_path = self.root_dir + route6_config_path(vlan_name)
-            all_file_names.append(vlan_path)
-            all_file_names.append(vlan_route_path)
-            all_file_names.append(vlan_route6_path)
-            if (utils.diff(vlan_path, vlan_data) or
-                    utils.diff(vlan_route_path, route_data)):
-                restart_vlans.append(vlan_name)
-                restart_vlans.extend(self.child_members(vlan_name))
-                update_files[vlan_path] = vlan_data
-                update_files[vlan_route_path] = route_data
-                update_files[vlan_route6_path] = route6_data
-            else:
-                logger.info('No changes required for vlan interface: %s' %
-                            vlan_name)
-
-        for bridge_name, bridge_data in self.bridge_data.iteritems():
-            route_data = self.route_data.get(bridge_name, '')
-            route6_data = self.route6_data.get(bridge_name, '')
-            bridge_path = self.root_dir + bridge_config_path(bridge_name)
-            br_route_path = self.root_dir + route_config_path(bridge_name)
-            br_route6_path = self.root_dir + route6_config_path(bridge_name)
-            all_file_names.append(bridge_path)
-            all_file_names.append(br_route_path)
-            all_file_names.append(br_route6_path)
-            if (utils.diff(bridge_path, bridge_data) or
-                utils.diff(br_route_path, route_data) or
-                utils.diff(br_route6_path, route6_data)):
-                restart_bridges.append(bridge_name)
-                restart_interfaces.extend(self.child_members(bridge_name))
-                update_files[bridge_path] = bridge_data
-                update_files[br_route_path] = route_data
-                update_files[br_route6_path] = route6_data
-            else:
-                logger.info('No changes required for bridge: %s' % bridge_name)
-
-        for bridge_name, bridge_data in self.linuxbridge_data.iteritems():
-            route_data = self.route_data.get(bridge_name, '')
-            route6_data = self.route6_data.get(bridge_name, '')
-            bridge_path = self.root_dir + bridge_config_path(bridge_name)
-            br_route_path = self.root_dir + route_config_path(bridge_name)
-            br_route6_path = self.root_dir + route6_config_path(bridge_name)
-            all_file_names.append(bridge_path)
-            all_file_names.append(br_route_path)
-            all_file_names.append(br_route6_path)
-            if (utils.diff(bridge_path, bridge_data) or
-                utils.diff(br_route_path, route_data) or
-                utils.diff(br_route6_path, route6_data)):
-                restart_bridges.append(bridge_name)
-                restart_interfaces.extend(self.child_members(bridge_name))
-                update_files[bridge_path] = bridge_data
-                update_files[br_route_path] = route_data
-                update_files[br_route6_path] = route6_data
-            else:
-                logger.info('No changes required for bridge: %s' % bridge_name)
-
-        for bond_name, bond_data in self.linuxbond_data.iteritems():
-            route_data = self.route_data.get(bond_name, '')
-            route6_data = self.route6_data.get(bond_name, '')
-            bond_path = self.root_dir + bridge_config_path(bond_name)
-            bond_route_path = self.root_dir + route_config_path(bond_name)
-            bond_route6_path = self.root_dir + route6_config_path(bond_name)
-            all_file_names.append(bond_path)
-            all_file_names.append(bond_route_path)
-            all_file_names.append(bond_route6_path)
-            if (utils.diff(bond_path, bond_data) or
-                utils.diff(bond_route_path, route_data) or
-                utils.diff(bond_route6_path, route6_data)):
-                restart_linux_bonds.append(bond_name)
-                restart_interfaces.extend(self.child_members(bond_name))
-                update_files[bond_path] = bond_data
-                update_files[bond_route_path] = route_data
-                update_files[bond_route6_path] = route6_data
-            else:
-                logger.info('No changes required for linux bond: %s' %
-                            bond_name)
+        all_file_names = set()
+        rendered = {}
+        # path -> device
+        owners = {}
+
+        # device data, restart list, restart list of its members, kind
+        devices = (
+            (self.interface_data, restart_interfaces, restart_interfaces,
+             'interface'),
+            (self.vlan_data, restart_vlans, restart_vlans, 'vlan interface'),
+            (self.bridge_data, restart_bridges, restart_interfaces,
+             'bridge'),
+            (self.linuxbridge_data, restart_bridges, restart_interfaces,
+             'bridge'),
+            (self.linuxbond_data, restart_linux_bonds, restart_interfaces,
+             'linux bond'))
+        for device_data, restart, restart_members, kind in devices:
+            for name, ifcfg_data in device_data.iteritems():
+                files = ((self.root_dir + ifcfg_config_path(name),
+                          ifcfg_data),
+                         (self.root_dir + route_config_path(name),
+                          self.route_data.get(name, '')),
+                         (self.root_dir + route6_config_path(name),
+                          self.route6_data.get(name, '')))
+                all_file_names.update(path for path, _data in files)
+                if name in self.unchanged_devices:
+                    continue
+                rendered[name] = files
+                diff_start = time.time()
+                changed = any(snapshot.diff(path, data)
+                              for path, data in files)
+                self._add_timing('diff', name, time.time() - diff_start)
+                if changed:
+                    owners.update((path, name) for path, _data in files)
+                    restart.append(name)
+                    restart_members.extend(self.child_members(name))
+                    update_files.update(files)
+                else:
+                    logger.info('No changes required for %s: %s' %
+                                (kind, name))
+
+        graph = self.device_graph
+        restart_vlans = graph.ordered(restart_vlans)
+        restart_linux_bonds = graph.ordered(restart_linux_bonds)
+        restart_bridges = graph.ordered(restart_bridges)
+        # Each device is restarted once, in the phase of its own type
+        dedicated = set(restart_vlans + restart_linux_bonds + restart_bridges)
+        restart_interfaces = [name for name in
+                              graph.ordered(restart_interfaces)
+                              if name not in dedicated]
+
+        self.phase_timings['diff'] = time.time() - start
 
         if cleanup:
-            for ifcfg_file in glob.iglob(cleanup_pattern()):
+            start = time.time()
+            pattern = self.root_dir + cleanup_pattern()
+            for ifcfg_file in snapshot.glob(pattern):
                 if ifcfg_file not in all_file_names:
-                    interface_name = ifcfg_file[len(cleanup_pattern()) - 1:]
+                    interface_name = ifcfg_file[len(pattern) - 1:]
                     if interface_name != 'lo':
                         logger.info('cleaning up interface: %s'
                                     % interface_name)
                         self.ifdown(interface_name)
                         self.remove_config(ifcfg_file)
+            self.phase_timings['cleanup'] = time.time() - start
 
+        bridges = set(restart_bridges)
+        restart = (restart_vlans + restart_interfaces + restart_linux_bonds +
+                   restart_bridges)
+        outage_start = time.time()
         if activate:
+            self._run_tasks('down', self._device_tasks('ifdown', restart,
+                                                       bridges, down=True))
+            self._run_tasks('rename', self._rename_tasks())
 
-            for vlan in restart_vlans:
-                self.ifdown(vlan)
+        start = time.time()
+        self._write_files(update_files, snapshot, owners)
+        self.phase_timings['write'] = time.time() - start
 
-            for interface in restart_interfaces:
-                self.ifdown(interface)
+        if activate:
+            tasks = self._device_tasks('ifup', restart, bridges)
+            for bond, primary in self.bond_primary_ifaces.iteritems():
+                # once the bond and its slaves are up
+                dependencies = [('ifup', bond)]
+                dependencies.extend(('ifup', member) for member in
+                                    self.child_members(bond))
+                tasks.append((('ovs_appctl', bond), dependencies,
+                              functools.partial(
+                                  self.ovs_appctl, 'bond/set-active-slave',
+                                  bond, primary)))
+            self._run_tasks('up', tasks)
+            self.phase_timings['outage'] = time.time() - outage_start
+            if self.noop and self.history is not None:
+                self.estimated_timings['write'] = self.history.phases.get(
+                    'write', 0)
+                self.estimated_timings['outage'] = sum(
+                    self.estimated_timings.values())
+
+        if self.journal is not None and not self.noop:
+            self._update_journal(rendered)
+        self._finish_report()
+        return update_files
 
-            for linux_bond in restart_linux_bonds:
-                self.ifdown(linux_bond)
+    def timing_report(self):
+        """Return the timings of the last apply() as a dict.
 
-            for bridge in restart_bridges:
-                self.ifdown(bridge, iftype='bridge')
+        The report has the phase timings, the timings of every device by
+        action and, in noop mode with a history, the estimated timings of
+        the down, rename, write and up phases and of the whole outage.
+        """
+        devices = {}
+        for action, timings in self.device_timings.items():
+            for name, seconds in timings.items():
+                devices.setdefault(name, {})[action] = seconds
+        report = {'noop': self.noop,
+                  'max_workers': self.scheduler.max_workers,
+                  'phases': self.phase_timings,
+                  'devices': devices}
+        if self.estimated_timings:
+            report['estimated'] = self.estimated_timings
+        return report
 
-            for oldname, newname in self.renamed_interfaces.iteritems():
-                self.ifrename(oldname, newname)
+    def _finish_report(self):
+        if not self.report_path:
+            return
+        if not self.noop:
+            self.history.update(self.device_timings, self.phase_timings)
+            self.history.save()
+        with open(self.report_path, 'w') as f:
+            json.dump(self.timing_report(), f, indent=2, sort_keys=True)
+        logger.info('Timing report written to %s' % self.report_path)
 
-        for location, data in update_files.iteritems():
-            self.write_config(location, data)
+    def _write_files(self, update_files, snapshot, owners):
+        """Write the changed files in one transaction.
 
-        if activate:
+        Files which already hold their data, including missing files
+        which would be empty, are not rewritten. Empty files are never
+        written: a file whose data became empty, like the route file of
+        a device whose routes were all removed, is removed instead.
+
+        :param owners: A dict of path to the device it configures, used
+            to record the write timings of each device.
+        """
+        transaction = ConfigTransaction()
+        for location, data in sorted(update_files.items()):
+            if not snapshot.diff(location, data):
+                logger.debug('%s is up to date' % location)
+                continue
+            if not data:
+                logger.info('%sRemoving config %s' % (self.log_prefix,
+                                                      location))
+                data = None
+            else:
+                logger.info('%sWriting config %s' % (self.log_prefix,
+                                                     location))
+            if not self.noop:
+                transaction.stage(location, data)
+        transaction.commit()
+        for location, seconds in transaction.timings.items():
+            self._add_timing('write', owners.get(location, location),
+                             seconds)
+
+    def _device_names(self):
+        names = set()
+        for device_data in (self.interface_data, self.vlan_data,
+                            self.bridge_data, self.linuxbridge_data,
+                            self.linuxbond_data):
+            names.update(device_data)
+        return names
 
-            for linux_bond in restart_linux_bonds:
-                self.ifup(linux_bond)
+    def _journal_edges(self):
+        graph = self.device_graph
+        return {'members': graph.members, 'lower': graph.lower}
 
-            for bridge in restart_bridges:
-                self.ifup(bridge, iftype='bridge')
+    def _journal_unchanged(self, snapshot, cleanup):
+        """Return True if the journal shows there is nothing to apply."""
+        if self.journal is None:
+            return False
+        names = self._device_names()
+        if (names != self.unchanged_devices or
+                names != set(self.journal.devices) or
+                self.journal.edges != self._journal_edges()):
+            return False
+        if cleanup:
+            known = set()
+            for entry in self.journal.devices.values():
+                known.update(entry['files'])
+            pattern = self.root_dir + cleanup_pattern()
+            for ifcfg_file in snapshot.glob(pattern):
+                if (ifcfg_file not in known and
+                        ifcfg_file[len(pattern) - 1:] != 'lo'):
+                    return False
+        return True
 
-            for interface in restart_interfaces:
-                self.ifup(interface)
+    def _update_journal(self, rendered):
+        journal = self.journal
+        names = self._device_names()
+        for name in list(journal.devices):
+            if name not in names:
+                del journal.devices[name]
+        for name, files in rendered.items():
+            journal.record(name, self._inputs[name], files)
+        journal.edges = self._journal_edges()
+        journal.save()
 
-            for bond in self.bond_primary_ifaces:
-                self.ovs_appctl('bond/set-active-slave', bond,
-                                self.bond_primary_ifaces[bond])
 
-            for vlan in restart_vlans:
-                self.ifup(vlan)
+# Renderer of the type specific options of each object type
+_RENDERER_TABLE = (
+    (objects.Vlan, IfcfgNetConfig._render_vlan),
+    (objects.OvsBridge, IfcfgNetConfig._render_ovs_bridge),
+    (objects.OvsBond, IfcfgNetConfig._render_ovs_bond),
+    (objects.LinuxBridge, IfcfgNetConfig._render_linux_bridge),
+    (objects.LinuxBond, IfcfgNetConfig._render_linux_bond),
+    (object, IfcfgNetConfig._render_interface))
+_RENDERERS = {}
 
-        return update_files
+
+def _renderer(cls):
+    for base, renderer in _RENDERER_TABLE:
+        if issubclass(cls, base):
+            _RENDERERS[cls] = renderer
+            return renderer
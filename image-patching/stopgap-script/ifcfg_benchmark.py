@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# Copyright 2015 Alcatel-Lucent USA Inc.
+# All Rights Reserved.
+
+"""Micro-benchmark of the ifcfg rendering of 7_files/impl_ifcfg.py.
+
+Renders a synthetic node, an OVS bridge over a two NIC bond carrying
+--vlans VLANs and --routes routes spread over them, with
+IfcfgNetConfig in noop mode and reports the best time out of --repeat
+runs. It needs os-net-config to be installed. With --baseline, the same
+node is also rendered by another copy of impl_ifcfg.py, for example
+one taken from an older commit, and both outputs are checked to be
+byte-identical:
+
+    git show HEAD~1:image-patching/stopgap-script/7_files/impl_ifcfg.py \\
+        > /tmp/impl_ifcfg_old.py
+    python ifcfg_benchmark.py --baseline /tmp/impl_ifcfg_old.py
+"""
+
+import argparse
+import imp
+import json
+import logging
+import os
+import sys
+import time
+
+from os_net_config import objects
+
+IMPL = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    '7_files', 'impl_ifcfg.py')
+
+
+def synthetic_node(vlans, routes):
+    """Return the JSON network config of the synthetic node."""
+    members = [{'type': 'ovs_bond', 'name': 'bond0', 'mtu': 1500,
+                'ovs_options': 'bond_mode=active-backup',
+                'members': [{'type': 'interface', 'name': 'nic1',
+                             'mtu': 1500},
+                            {'type': 'interface', 'name': 'nic2',
+                             'mtu': 1500}]}]
+    for index in range(vlans):
+        vlan_routes = []
+        for route in range(index, routes, vlans):
+            if route % 2:
+                vlan_routes.append({'next_hop': 'fd00:%x::1' % index,
+                                    'ip_netmask': 'fd10:%x::/64' % route})
+            else:
+                vlan_routes.append({
+                    'next_hop': '10.%d.%d.1' % (index // 256, index % 256),
+                    'ip_netmask': '172.%d.%d.0/24' % (
+                        16 + route // 65536, route // 256 % 256)})
+        members.append({
+            'type': 'vlan', 'vlan_id': index + 1, 'mtu': 9000,
+            'addresses': [
+                {'ip_netmask': '10.%d.%d.2/24' % (index // 256,
+                                                  index % 256)},
+                {'ip_netmask': 'fd00:%x::2/64' % index}],
+            'routes': vlan_routes})
+    return [{'type': 'ovs_bridge', 'name': 'br-ex', 'mtu': 1500,
+             'use_dhcp': True, 'members': members}]
+
+
+def render(impl, config):
+    provider = impl.IfcfgNetConfig(noop=True, root_dir='/nonexistent')
+    for obj in config:
+        provider.add_object(obj)
+    return provider
+
+
+def _output(provider):
+    return dict((name, getattr(provider, name)) for name in (
+        'interface_data', 'vlan_data', 'bridge_data', 'linuxbridge_data',
+        'linuxbond_data', 'route_data', 'route6_data'))
+
+
+def best_time(impl, config, repeat):
+    best = None
+    for _i in range(repeat):
+        start = time.time()
+        provider = render(impl, config)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, provider
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--vlans', type=int, default=1000)
+    parser.add_argument('--routes', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--impl', default=IMPL,
+                        help='impl_ifcfg.py to benchmark')
+    parser.add_argument('--baseline',
+                        help='Another impl_ifcfg.py to compare with')
+    parser.add_argument('--output', help='Write the results to this file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    config = [objects.object_from_json(obj)
+              for obj in synthetic_node(args.vlans, args.routes)]
+    seconds, provider = best_time(imp.load_source('impl_ifcfg', args.impl),
+                                  config, args.repeat)
+    results = {'python': sys.version.split()[0], 'vlans': args.vlans,
+               'routes': args.routes, 'seconds': seconds}
+    if args.baseline:
+        baseline_seconds, baseline = best_time(
+            imp.load_source('impl_ifcfg_baseline', args.baseline),
+            config, args.repeat)
+        results['baseline_seconds'] = baseline_seconds
+        results['speedup'] = baseline_seconds / seconds
+        results['identical'] = _output(provider) == _output(baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if not results.get('identical', True):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
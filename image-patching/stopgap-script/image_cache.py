@@ -0,0 +1,174 @@
+# Copyright 2015 Alcatel-Lucent USA Inc.
+# All Rights Reserved.
+
+"""Content-addressed cache of patched image layers.
+
+Every stage of a layered patch is stored as a qcow2 overlay whose
+backing file is the result of the stage before it, named after a digest
+of the stage inputs chained with the digest of that previous stage. The
+first stage is backed by a copy of the base image named after its
+content digest, so that editing or replacing the base image invalidates
+the whole chain instead of corrupting it.
+
+A rebuild reuses every stage up to the first one whose inputs changed
+and only runs virt-customize for the stages after it.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+
+LOG = logging.getLogger(__name__)
+CHUNK_SIZE = 1024 * 1024
+DIGESTS_FILE = 'digests.json'
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def path_digest(path, exclude=()):
+    """Return the digest of a file, or of the files of a directory.
+
+    :param exclude: Names of the entries of a directory to leave out.
+    """
+    if not os.path.isdir(path):
+        return file_digest(path)
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        if root == path:
+            dirs[:] = [name for name in dirs if name not in exclude]
+            files = [name for name in files if name not in exclude]
+        dirs.sort()
+        for name in sorted(files):
+            full_path = os.path.join(root, name)
+            digest.update(os.path.relpath(full_path, path).encode('utf-8'))
+            digest.update(file_digest(full_path).encode('ascii'))
+    return digest.hexdigest()
+
+
+def _qemu_img(*args):
+    subprocess.check_call(('qemu-img',) + args)
+
+
+@contextlib.contextmanager
+def _locked(path):
+    """Hold an exclusive lock next to path.
+
+    Concurrent builds sharing a cache wait for each other instead of
+    building the same layer twice.
+    """
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+class LayerCache(object):
+    """Directory of qcow2 layers keyed by the digest of their inputs.
+
+    :param directory: The cache directory, created if needed.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # base image path -> [size, mtime, digest]
+        self._digests_path = os.path.join(self.directory, DIGESTS_FILE)
+        self._digests = {}
+        try:
+            with open(self._digests_path) as f:
+                self._digests = json.load(f)
+        except IOError:
+            pass
+        except ValueError:
+            LOG.warning('Ignoring unreadable %s', self._digests_path)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.qcow2')
+
+    def image_digest(self, image):
+        """Return the digest of an image, cached by size and mtime."""
+        image = os.path.abspath(image)
+        st = os.stat(image)
+        cached = self._digests.get(image)
+        if cached and cached[:2] == [st.st_size, st.st_mtime]:
+            return cached[2]
+        LOG.info('Computing the digest of %s', image)
+        digest = file_digest(image)
+        self._digests[image] = [st.st_size, st.st_mtime, digest]
+        tmp_path = '%s.%d.tmp' % (self._digests_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self._digests, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self._digests_path)
+        return digest
+
+    def base(self, image):
+        """Return (key, path) of the cached copy of a base image."""
+        key = 'base-' + self.image_digest(image)
+        path = self.path(key)
+        with _locked(path):
+            if not os.path.exists(path):
+                LOG.info('Copying %s to the layer cache', image)
+                shutil.copyfile(image, path + '.tmp')
+                os.rename(path + '.tmp', path)
+        return key, path
+
+    @staticmethod
+    def key(parent_key, inputs):
+        """Return the key of a layer.
+
+        :param parent_key: The key of the layer it is built on.
+        :param inputs: A list of strings describing what the layer does.
+        """
+        digest = hashlib.sha256(parent_key.encode('utf-8'))
+        for data in inputs:
+            digest.update(b'\0')
+            digest.update(data.encode('utf-8'))
+        return digest.hexdigest()
+
+    def layer(self, parent_path, key, build):
+        """Return (path, cached) of a layer, building it if needed.
+
+        :param parent_path: The path of the layer it is built on.
+        :param build: A function of the path of a new overlay of
+            parent_path, which it must turn into the layer.
+        """
+        path = self.path(key)
+        with _locked(path):
+            if os.path.exists(path):
+                return path, True
+            tmp_path = path + '.tmp'
+            _qemu_img('create', '-q', '-f', 'qcow2', '-F', 'qcow2',
+                      '-b', parent_path, tmp_path)
+            try:
+                build(tmp_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            os.rename(tmp_path, path)
+        return path, False
+
+    @staticmethod
+    def export(path, output, flatten=False):
+        """Make output an image with the content of the layer at path.
+
+        Unless flatten, output is a thin overlay backed by the cache, so
+        that changes made to it later do not alter the cached layers.
+        """
+        tmp_path = output + '.tmp'
+        if flatten:
+            _qemu_img('convert', '-O', 'qcow2', path, tmp_path)
+        else:
+            _qemu_img('create', '-q', '-f', 'qcow2', '-F', 'qcow2',
+                      '-b', path, tmp_path)
+        os.rename(tmp_path, output)
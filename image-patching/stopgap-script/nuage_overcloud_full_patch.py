@@ -0,0 +1,822 @@
+#!/usr/bin/env python
+# Copyright 2015 Alcatel-Lucent USA Inc.
+# All Rights Reserved.
+
+"""Patch an overcloud image with Nuage components in one appliance session.
+
+This does what nuage_overcloud_full_patch.sh (or, with --Cbis,
+nuage_overcloud_full_patch_cbis.sh) does, with the same options:
+
+1. Subscribe to RHEL and the pool (not with --Cbis)
+2. Uninstall OVS
+3. Create the local repo file for Nuage packages
+4. Install neutron-client, netlib, metadata agent
+5. Install VRS
+6. Remove the repo file and unsubscribe from RHEL
+7. Add the files of --Version
+
+The shell scripts run virt-customize once per step, each time booting a
+new libguestfs appliance and relabelling the whole image. Here the steps
+are compiled into a single virt-customize run, relabelled once at the
+end, and the time spent in each step is reported from the progress
+messages of virt-customize:
+
+    python nuage_overcloud_full_patch.py --ImageName=overcloud-full.qcow2 \\
+        --RhelUserName=user --RhelPassword=password --RhelPool=pool \\
+        --RepoName=Nuage --RepoBaseUrl=http://repo/nuage --Version=9
+
+With --CacheDir, the image is built in layers instead: package removal,
+Nuage packages, VRS, the files of --Version and the relabel. Each layer
+is a qcow2 overlay cached under a digest of its inputs (the base image,
+package lists, the repodata of --RepoBaseUrl and file contents), so a
+rebuild only runs the layers after the first one which changed. The
+result is written to --Output, as a thin overlay of the cached layers
+unless --Flatten is given.
+
+With --Targets, several images are patched at once, each as if given on
+its own command line. The file has one "<ImageName> <Version> [cbis]"
+line per image. Up to --Jobs images are patched concurrently, by default
+as many as the free memory of the host fits appliances of --MemSize.
+
+With --RpmCacheDir, the Nuage packages are downloaded once on the host,
+verified against the checksums of the repodata and copied into the
+appliances instead of being downloaded by yum in each of them.
+
+With --OfflineRepo, nothing is downloaded and RHEL is not subscribed to:
+a local repo is built on the host out of the RPMs of that directory and
+the nuage-puppet-modules RPMs shipped in image-patching, keeping only
+the Nuage packages and their dependencies, and yum installs from it
+alone inside the appliance.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from shlex import quote
+    from urllib.request import urlopen
+except ImportError:
+    # Python 2
+    from pipes import quote
+    from urllib2 import urlopen
+
+from image_cache import LayerCache
+from image_cache import path_digest
+from rpm_cache import RpmCache
+from rpm_cache import RpmCacheError
+from rpm_cache import create_repo
+from rpm_cache import dependency_closure
+from rpm_cache import parse_primary
+from rpm_cache import read_metadata
+
+logging.basicConfig(format='%(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# List of Nuage packages
+NUAGE_PACKAGES = ['nuage-openstack-neutron', 'nuagenetlib',
+                  'nuage-openstack-neutronclient', 'nuage-metadata-agent',
+                  'nuage-puppet-modules', 'nuage-openstack-heat',
+                  'nuage-openstack-horizon', 'selinux-policy-nuage']
+NUAGE_DEPENDENCIES = ['libvirt', 'perl-JSON', 'python-novaclient']
+CBIS_NUAGE_PACKAGES = ['nuage-openstack-neutron', 'nuagenetlib',
+                       'nuage-openstack-neutronclient',
+                       'nuage-metadata-agent', 'nuage-puppet-modules',
+                       'nuage-openstack-heat', 'nuage-openstack-horizon']
+CBIS_NUAGE_DEPENDENCIES = ['libvirt', 'python-twisted-core', 'perl-JSON',
+                           'qemu-kvm', 'vconfig', 'python-novaclient']
+NUAGE_VRS_PACKAGE = 'nuage-openvswitch'
+VIRT_CUSTOMIZE_MEMSIZE = '2048'
+
+VERSIONS = (7, 8, 9, 10)
+CBIS_VERSIONS = (7, 8, 9)
+FILES_DIR = os.path.dirname(os.path.abspath(__file__))
+MANIFESTS_DIR = '/etc/puppet/modules/nuage/manifests'
+NUAGE_REPO = '/etc/yum.repos.d/nuage.repo'
+RPMS_DIR = '/var/tmp/nuage-rpms'
+OFFLINE_REPO_NAME = 'nuage-offline-repo'
+OFFLINE_REPO_PARENT = '/var/tmp'
+OFFLINE_YUM_OPTIONS = ["--disablerepo='*'", '--enablerepo=Nuage']
+# Removals need no repo, and the Nuage one is not there yet
+OFFLINE_REMOVE_OPTIONS = ["--disablerepo='*'"]
+BUNDLED_RPMS = os.path.join(os.path.dirname(FILES_DIR),
+                            'nuage-puppet-modules-*.rpm')
+MASK = '********'
+AUTORELABEL_EDIT = ('/usr/lib/systemd/system/rhel-autorelabel.service: '
+                    '$_ = "" if /StandardInput=tty/')
+
+# version -> (file in <version>_files, destination in the image)
+VERSION_FILES = {
+    7: [('neutron_plugin_nuage.rb',
+         '/etc/puppet/modules/neutron/lib/puppet/type/'
+         'neutron_plugin_nuage.rb'),
+        ('impl_ifcfg.py',
+         '/usr/lib/python2.7/site-packages/os_net_config/impl_ifcfg.py'),
+        ('ini_setting.rb',
+         '/etc/puppet/modules/neutron/lib/puppet/provider/'
+         'neutron_plugin_nuage/ini_setting.rb')],
+    8: [('neutron_plugin_nuage.rb',
+         '/etc/puppet/modules/neutron/lib/puppet/type/'
+         'neutron_plugin_nuage.rb')],
+    9: [('nuage.pp', '/etc/puppet/modules/neutron/manifests/plugins/'
+                     'nuage.pp')],
+    10: [],
+}
+
+# "[  12.3] Running: ..." lines printed by virt-customize
+PROGRESS_RE = re.compile(r'^\[\s*(\d+(?:\.\d+)?)\]\s+(.*?)\s*$')
+
+
+class Step(object):
+    """One step of a patch plan.
+
+    :param name: Short name of the step, used in the timing report.
+    :param operations: List of (virt-customize option, argument) pairs,
+        with None as the argument of options which take none.
+    :param scripts: Dict of script file name to content for the --run
+        operations of the step.
+    :param volatile: True if the step does not change what ends up in the
+        image, like the RHEL subscription, so that it is left out of the
+        cache keys of layered builds.
+    :param always: True if the step must run even when an earlier step
+        of the plan failed, like the RHEL unsubscription.
+    """
+
+    def __init__(self, name, operations=None, scripts=None, volatile=False,
+                 always=False):
+        self.name = name
+        self.operations = operations or []
+        self.scripts = scripts or {}
+        self.volatile = volatile
+        self.always = always
+        # scripts with their credentials masked, to be printed instead
+        self.masked_scripts = {}
+
+    def run(self, name, lines, masked_lines=None):
+        """Add a --run of a script made of lines.
+
+        :param masked_lines: The lines with their credentials masked, if
+            they have any.
+        """
+        self.scripts[name] = ''.join(line + '\n' for line in lines)
+        if masked_lines is not None:
+            self.masked_scripts[name] = ''.join(line + '\n'
+                                                for line in masked_lines)
+        self.operations.append(('--run', name))
+        return self
+
+
+def _yum(action, packages, options=()):
+    return 'yum %s -y' % ' '.join(list(options) + [action] + packages)
+
+
+def _install(name, script, package_lists, rpms, options=()):
+    """Return a Step installing lists of packages with one yum each.
+
+    The packages found in rpms, a dict of name to RPM on the host, are
+    copied into the image and installed from there.
+    """
+    step = Step(name)
+    lines = []
+    for packages in package_lists:
+        local = [package for package in packages if package in rpms]
+        if local and not step.operations:
+            step.operations.append(('--mkdir', RPMS_DIR))
+        for package in local:
+            step.operations.append(('--copy-in', '%s:%s' % (rpms[package],
+                                                            RPMS_DIR)))
+        lines.append(_yum('install', [
+            RPMS_DIR + '/' + os.path.basename(rpms[package])
+            if package in rpms else package for package in packages],
+            options))
+    return step.run(script, lines)
+
+
+def build_stages(args, layered=False, rpms=None, offline_repo=None):
+    """Return the plan of args as a list of (stage name, Steps) pairs.
+
+    Unless layered, there is a single 'patch' stage subscribing once and
+    relabelling once. Layered stages are built one at a time on top of
+    each other, so every stage installing packages subscribes, adds the
+    repo file and cleans both up on its own.
+
+    :param rpms: A dict of package name to RPM on the host, for the
+        packages to copy into the image rather than download with yum.
+    :param offline_repo: A local repo on the host. If given, it is
+        copied into the image and yum only uses it.
+    """
+    rpms = rpms or {}
+    cbis = getattr(args, 'Cbis', False)
+    options = OFFLINE_YUM_OPTIONS if offline_repo else []
+    remove_options = OFFLINE_REMOVE_OPTIONS if offline_repo else []
+    prepare = Step('prepare', [('--edit', AUTORELABEL_EDIT)])
+    subscribe = []
+    unsubscribe = []
+    if not cbis and not offline_repo:
+        register = ('subscription-manager register --username=%s '
+                    '--password=%s')
+        lines = ['subscription-manager subscribe --pool=%s' %
+                 quote(args.RhelPool),
+                 'subscription-manager repos '
+                 '--enable=rhel-7-server-optional-rpms',
+                 'subscription-manager repos --enable=rhel-7-server-rpms']
+        subscribe.append(Step('subscribe', volatile=True).run(
+            'rhel_subscription',
+            [register % (quote(args.RhelUserName),
+                         quote(args.RhelPassword))] + lines,
+            [register % (MASK, MASK)] + lines))
+        unsubscribe.append(Step('unsubscribe', volatile=True,
+                                always=True).run(
+            'rhel_unsubscribe', ['subscription-manager unregister']))
+
+    uninstall = []
+    # For Newton and above, use standard python-openvswitch
+    if args.Version <= 9:
+        uninstall.append(_yum('remove', ['python-openvswitch'],
+                              remove_options))
+    uninstall.append(_yum('remove', ['openvswitch'], remove_options))
+    uninstall = Step('uninstall').run('uninstall_packages', uninstall)
+
+    repo = Step('repo')
+    cleanup = Step('cleanup', [('--delete', NUAGE_REPO)])
+    base_url = args.RepoBaseUrl
+    if offline_repo:
+        guest_repo = '%s/%s' % (OFFLINE_REPO_PARENT,
+                                os.path.basename(offline_repo))
+        repo.operations.append(('--copy-in', '%s:%s' % (
+            offline_repo, OFFLINE_REPO_PARENT)))
+        cleanup.operations.append(('--delete', guest_repo))
+        base_url = 'file://' + guest_repo
+    repo.operations.append(('--write', '%s:%s' % (NUAGE_REPO, ''.join([
+        '[Nuage]\n', 'name=%s\n' % args.RepoName,
+        'baseurl=%s\n' % base_url, 'enabled = 1\n', 'gpgcheck = 0\n']))))
+    packages = _install('packages', 'nuage_packages', [
+        CBIS_NUAGE_DEPENDENCIES if cbis else NUAGE_DEPENDENCIES,
+        CBIS_NUAGE_PACKAGES if cbis else NUAGE_PACKAGES], rpms, options)
+    vrs = _install('vrs', 'vrs_packages', [[NUAGE_VRS_PACKAGE]], rpms,
+                   options)
+    if rpms:
+        cleanup.operations.append(('--delete', RPMS_DIR))
+
+    files = []
+    version_files = VERSION_FILES[args.Version]
+    if version_files:
+        directory = '%s/%d_files' % (MANIFESTS_DIR, args.Version)
+        step = Step('files', [('--mkdir', directory)])
+        for name, _destination in version_files:
+            step.operations.append(('--copy-in', '%s:%s' % (os.path.join(
+                FILES_DIR, '%d_files' % args.Version, name), directory)))
+        step.run('add_files', ['cp %s %s' % (quote(directory + '/' + name),
+                                             quote(destination))
+                               for name, destination in version_files])
+        files.append(step)
+    relabel = Step('selinux-relabel', [('--selinux-relabel', None)])
+
+    if not layered:
+        return [('patch', [prepare] + subscribe +
+                 [uninstall, repo, packages, vrs, cleanup] + unsubscribe +
+                 files + [relabel])]
+    stages = [('uninstall', [prepare] + subscribe + [uninstall] +
+               unsubscribe),
+              ('packages', subscribe + [repo, packages, cleanup] +
+               unsubscribe),
+              ('vrs', subscribe + [repo, vrs, cleanup] + unsubscribe)]
+    if files:
+        stages.append(('files', files))
+    stages.append(('selinux-relabel', [relabel]))
+    return stages
+
+
+def build_plan(args, rpms=None, offline_repo=None):
+    """Return the list of Steps patching an image for args at once."""
+    return build_stages(args, rpms=rpms, offline_repo=offline_repo)[0][1]
+
+
+def _message(option, argument):
+    """Return the progress message virt-customize prints for an option."""
+    if option in ('--run', '--run-command'):
+        return 'Running: %s' % argument
+    if option == '--copy-in':
+        return 'Copying: %s to %s' % tuple(argument.rsplit(':', 1))
+    if option == '--mkdir':
+        return 'Making directory: %s' % argument
+    if option == '--write':
+        return 'Writing: %s' % argument.split(':', 1)[0]
+    if option == '--delete':
+        return 'Deleting: %s' % argument
+    if option == '--edit':
+        return 'Editing: %s' % argument.split(':', 1)[0]
+    if option == '--selinux-relabel':
+        return 'SELinux relabelling'
+    return None
+
+
+def virt_customize_command(image, plan, script_dir,
+                           memsize=VIRT_CUSTOMIZE_MEMSIZE):
+    """Return the virt-customize command line running a plan.
+
+    The scripts of --run operations are referred to in script_dir.
+    """
+    command = ['virt-customize', '-a', image, '--memsize', str(memsize)]
+    for step in plan:
+        for option, argument in step.operations:
+            if option == '--run':
+                argument = os.path.join(script_dir, argument)
+            command.append(option)
+            if argument is not None:
+                command.append(argument)
+    return command
+
+
+def step_timings(plan, progress, script_dir, total):
+    """Return a list of (step name, seconds) out of progress messages.
+
+    :param progress: List of (seconds, message) virt-customize progress
+        messages.
+    :param total: Seconds the whole run took.
+
+    The time before the first message of the plan is reported as the
+    'launch' step, and every message is charged to the step of the
+    latest expected message seen.
+    """
+    expected = []
+    for step in plan:
+        for option, argument in step.operations:
+            if option == '--run':
+                argument = os.path.join(script_dir, argument)
+            message = _message(option, argument)
+            if message:
+                expected.append((message, step.name))
+    timings = [('launch', 0.0)]
+    position = 0
+    previous = 0.0
+    for seconds, message in progress:
+        name, elapsed = timings[-1]
+        timings[-1] = (name, elapsed + seconds - previous)
+        previous = seconds
+        if position < len(expected) and message == expected[position][0]:
+            if expected[position][1] != name:
+                timings.append((expected[position][1], 0.0))
+            position += 1
+    name, elapsed = timings[-1]
+    timings[-1] = (name, elapsed + max(0.0, total - previous))
+    return timings
+
+
+def _virt_customize(command, prefix):
+    """Run virt-customize, returning its (seconds, message) progress."""
+    progress = []
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               universal_newlines=True)
+    for line in iter(process.stdout.readline, ''):
+        sys.stdout.write(prefix + line)
+        match = PROGRESS_RE.match(line)
+        if match:
+            progress.append((float(match.group(1)), match.group(2)))
+    process.stdout.close()
+    if process.wait():
+        raise subprocess.CalledProcessError(process.returncode, command[0])
+    return progress
+
+
+def run_plan(image, plan, memsize=VIRT_CUSTOMIZE_MEMSIZE, dry_run=False,
+             prefix=''):
+    """Patch image with a plan in one virt-customize run.
+
+    Returns the list of (step name, seconds) of the run. If the run
+    fails, the steps of the plan which must always run, like the RHEL
+    unsubscription, are run on their own in a second virt-customize
+    before the error is raised, so that a failed patch does not leave
+    the image registered.
+
+    :param prefix: Prepended to the output lines of virt-customize.
+    """
+    script_dir = tempfile.mkdtemp(prefix='nuage-patch-')
+    try:
+        os.chmod(script_dir, 0o700)
+        for step in plan:
+            for name, content in step.scripts.items():
+                with open(os.path.join(script_dir, name), 'w') as f:
+                    f.write(content)
+        command = virt_customize_command(image, plan, script_dir, memsize)
+        if dry_run:
+            print(' '.join(quote(arg) for arg in command))
+            for step in plan:
+                for name, content in sorted(step.scripts.items()):
+                    print('# %s\n%s' % (
+                        name, step.masked_scripts.get(name, content)))
+            return []
+
+        start = time.time()
+        try:
+            progress = _virt_customize(command, prefix)
+        except subprocess.CalledProcessError as error:
+            always = [step for step in plan if step.always]
+            if always:
+                logger.error('%sPatching %s failed, running %s on its own' %
+                             (prefix, image, ', '.join(step.name
+                                                       for step in always)))
+                try:
+                    _virt_customize(virt_customize_command(
+                        image, always, script_dir, memsize), prefix)
+                except (OSError, subprocess.CalledProcessError) as e:
+                    logger.error('%sCould not run %s on %s: %s' % (
+                        prefix, ', '.join(step.name for step in always),
+                        image, e))
+            raise error
+        return step_timings(plan, progress, script_dir, time.time() - start)
+    finally:
+        shutil.rmtree(script_dir)
+
+
+def repo_digest(base_url):
+    """Return the digest of the repomd.xml of a yum repo.
+
+    If the repo cannot be read, a random value is returned so that the
+    layers installing from it are rebuilt.
+    """
+    url = base_url.rstrip('/') + '/repodata/repomd.xml'
+    try:
+        response = urlopen(url, timeout=30)
+        try:
+            return hashlib.sha256(response.read()).hexdigest()
+        finally:
+            response.close()
+    except (IOError, OSError) as e:
+        logger.warning('Could not read %s, rebuilding the package layers: '
+                       '%s' % (url, e))
+        return hashlib.sha256(os.urandom(32)).hexdigest()
+
+
+def stage_inputs(steps, repo):
+    """Return the list of strings a layer built by steps depends on.
+
+    :param repo: Digest of the Nuage repo, added for the steps writing
+        the repo file.
+    """
+    inputs = []
+    for step in steps:
+        if step.volatile:
+            continue
+        inputs.append(step.name)
+        for option, argument in step.operations:
+            if option == '--copy-in':
+                # Host paths may be temporary, only what is copied counts.
+                # The repodata of a local repo carries timestamps, and is
+                # made out of the RPMs anyway.
+                path, directory = argument.rsplit(':', 1)
+                inputs.append('%s %s:%s' % (option, os.path.basename(path),
+                                            directory))
+                inputs.append(path_digest(path, exclude=('repodata',)))
+                continue
+            inputs.append('%s %s' % (option, argument))
+            if (option == '--write' and
+                    argument.startswith(NUAGE_REPO + ':')):
+                inputs.append(repo)
+        for name, content in sorted(step.scripts.items()):
+            inputs.extend((name, content))
+    return inputs
+
+
+def build_layers(args, cache, dry_run=False, rpms=None, prefix='',
+                 offline_repo=None):
+    """Build the layers of args in cache and export the last one.
+
+    Returns a list of (stage name, key, cached, step timings) tuples.
+    """
+    stages = build_stages(args, layered=True, rpms=rpms,
+                          offline_repo=offline_repo)
+    # the content of an offline repo is part of the inputs already
+    repo = '' if offline_repo else repo_digest(args.RepoBaseUrl)
+    if dry_run:
+        key = 'base-' + cache.image_digest(args.ImageName)
+    else:
+        key, path = cache.base(args.ImageName)
+    results = []
+    for name, steps in stages:
+        key = cache.key(key, [name] + stage_inputs(steps, repo))
+        if dry_run:
+            cached = os.path.exists(cache.path(key))
+            print('# %s layer %s%s' % (name, key,
+                                       ' (cached)' if cached else ''))
+            if not cached:
+                run_plan(cache.path(key), steps, args.MemSize, dry_run=True)
+            continue
+        timings = []
+
+        def build(overlay):
+            logger.info('%sBuilding the %s layer' % (prefix, name))
+            timings.extend(run_plan(overlay, steps, args.MemSize,
+                                    prefix=prefix))
+
+        path, cached = cache.layer(path, key, build)
+        if cached:
+            logger.info('%sReusing the cached %s layer' % (prefix, name))
+        results.append((name, key, cached, timings))
+    if not dry_run:
+        cache.export(path, args.Output, args.Flatten)
+    return results
+
+
+def have_libguestfs_tools():
+    try:
+        return not subprocess.call(['rpm', '-q', '--quiet',
+                                    'libguestfs-tools-c'])
+    except OSError:
+        # not an RPM based host
+        return any(os.access(os.path.join(directory, 'virt-customize'),
+                             os.X_OK)
+                   for directory in os.environ['PATH'].split(os.pathsep))
+
+
+def init_arg_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.split('\n')[2:]))
+    parser.add_argument('--ImageName',
+                        help='Name of the qcow2 image (overcloud-full.qcow2 '
+                             'for example)')
+    parser.add_argument('--RhelUserName',
+                        help='User name for RHELSubscription')
+    parser.add_argument('--RhelPassword',
+                        help='Password for the RHEL Subscription')
+    parser.add_argument('--RhelPool',
+                        help='Pool to subscribe to for base packages')
+    parser.add_argument('--RepoName', required=True,
+                        help='Name for the local repo hosting the Nuage RPMs')
+    parser.add_argument('--RepoBaseUrl',
+                        help='Base URL for the repo hosting the Nuage RPMs')
+    parser.add_argument('--Version', type=int,
+                        choices=VERSIONS,
+                        help='OSP-Director version (7, 8, 9 or 10)?')
+    parser.add_argument('--Cbis', action='store_true',
+                        help='Patch a CBIS image: CBIS packages, no RHEL '
+                             'subscription, versions 7, 8 or 9')
+    parser.add_argument('--MemSize', default=VIRT_CUSTOMIZE_MEMSIZE,
+                        help='Memory of the appliance in MB')
+    parser.add_argument('--Report',
+                        help='Write the step timings to this JSON file')
+    parser.add_argument('--CacheDir',
+                        help='Build the image in layers cached in this '
+                             'directory')
+    parser.add_argument('--Output',
+                        help='Patched image written by --CacheDir builds '
+                             '(default: <ImageName>-nuage.qcow2)')
+    parser.add_argument('--Flatten', action='store_true',
+                        help='Write --Output as a standalone image instead '
+                             'of an overlay of the cached layers')
+    parser.add_argument('--Targets',
+                        help='File of "<ImageName> <Version> [cbis]" lines '
+                             'to patch instead of --ImageName')
+    parser.add_argument('--Jobs', type=int,
+                        help='Number of --Targets images patched at once '
+                             '(default: as many as the host memory fits)')
+    parser.add_argument('--RpmCacheDir',
+                        help='Download the Nuage packages once into this '
+                             'directory and copy them into the images')
+    parser.add_argument('--OfflineRepo',
+                        help='Directory of RPMs to install from, without '
+                             'network access or RHEL subscription')
+    parser.add_argument('--DryRun', action='store_true',
+                        help='Print the virt-customize command and scripts '
+                             'instead of running them')
+    return parser
+
+
+def check_args(parser, args):
+    if args.Cbis and args.Version not in CBIS_VERSIONS:
+        parser.error('--Version must be 7, 8 or 9 with --Cbis')
+    if args.OfflineRepo:
+        if args.RpmCacheDir:
+            parser.error('--RpmCacheDir cannot be used with --OfflineRepo')
+        return
+    if not args.RepoBaseUrl:
+        parser.error('--RepoBaseUrl is required')
+    if not args.Cbis and not (args.RhelUserName and args.RhelPassword and
+                              args.RhelPool):
+        parser.error('--RhelUserName, --RhelPassword and --RhelPool are '
+                     'required')
+
+
+def read_targets(parser, args):
+    """Return a copy of args for each line of the --Targets file."""
+    targets = []
+    with open(args.Targets) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            if (len(fields) not in (2, 3) or not fields[1].isdigit() or
+                    fields[2:] not in ([], ['cbis'])):
+                parser.error('Invalid target in %s: %s' % (args.Targets,
+                                                           line.strip()))
+            target = argparse.Namespace(**vars(args))
+            target.ImageName = fields[0]
+            target.Version = int(fields[1])
+            target.Cbis = fields[2:] == ['cbis']
+            target.Output = None
+            if target.Version not in VERSIONS:
+                parser.error('Invalid version of %s: %d' %
+                             (target.ImageName, target.Version))
+            check_args(parser, target)
+            targets.append(target)
+    images = [target.ImageName for target in targets]
+    if len(set(images)) < len(images) and not args.CacheDir:
+        parser.error('An image can only be listed once in %s unless '
+                     '--CacheDir is given' % args.Targets)
+    return targets
+
+
+def default_jobs(memsize, count):
+    """Return how many appliances of memsize MB the host can run."""
+    try:
+        with open('/proc/meminfo') as f:
+            meminfo = dict(line.split(':', 1) for line in f)
+        free = int(meminfo.get('MemAvailable', meminfo['MemTotal']).split()[0])
+    except (IOError, KeyError, ValueError):
+        return 1
+    return max(1, min(count, multiprocessing.cpu_count(),
+                      free // 1024 // int(memsize)))
+
+
+def patch(args, rpms=None, prefix='', offline_repo=None):
+    """Patch the image of args and return the report of the run."""
+    report = {'image': args.ImageName, 'version': args.Version,
+              'cbis': args.Cbis}
+    start = time.time()
+    if args.CacheDir:
+        if not args.Output:
+            args.Output = '%s-nuage.qcow2' % os.path.splitext(
+                args.ImageName)[0]
+        layers = build_layers(args, LayerCache(args.CacheDir), args.DryRun,
+                              rpms, prefix, offline_repo)
+        report['output'] = args.Output
+        report['layers'] = [
+            {'name': name, 'key': key, 'cached': cached,
+             'steps': [{'name': step, 'seconds': seconds}
+                       for step, seconds in timings]}
+            for name, key, cached, timings in layers]
+        timings = [('%s/%s' % (name, step), seconds)
+                   for name, _key, _cached, steps in layers
+                   for step, seconds in steps]
+    else:
+        timings = run_plan(args.ImageName,
+                           build_plan(args, rpms, offline_repo),
+                           args.MemSize, args.DryRun, prefix)
+        report['steps'] = [{'name': name, 'seconds': seconds}
+                           for name, seconds in timings]
+    report['total_seconds'] = time.time() - start
+    if not args.DryRun:
+        for name, seconds in timings:
+            logger.info('%s%-24s %8.1fs' % (prefix, name, seconds))
+        logger.info('%s%-24s %8.1fs' % (prefix, 'total',
+                                        report['total_seconds']))
+    return report
+
+
+def _patch_target(target_packages):
+    target, rpms, offline_repo = target_packages
+    prefix = '%s: ' % target.ImageName
+    try:
+        return patch(target, rpms, prefix, offline_repo)
+    except Exception as e:
+        # Whatever goes wrong with one image must not lose the reports
+        # of the others in pool.map
+        logger.error('%sFailed to patch %s: %s' % (prefix, target.ImageName,
+                                                   e))
+        return {'image': target.ImageName, 'version': target.Version,
+                'cbis': target.Cbis, 'error': str(e)}
+
+
+def _package_names(targets):
+    names = set([NUAGE_VRS_PACKAGE])
+    for target in targets:
+        if target.Cbis:
+            names.update(CBIS_NUAGE_DEPENDENCIES + CBIS_NUAGE_PACKAGES)
+        else:
+            names.update(NUAGE_DEPENDENCIES + NUAGE_PACKAGES)
+    return names
+
+
+def fetch_rpms(args, targets):
+    """Return a dict of the Nuage packages of targets to cached RPMs."""
+    names = _package_names(targets)
+    rpms = RpmCache(args.RpmCacheDir).fetch(args.RepoBaseUrl, names)
+    logger.info('%d of %d packages cached from %s' % (
+        len(rpms), len(names), args.RepoBaseUrl))
+    return rpms
+
+
+def build_offline_repo(args, targets, directory):
+    """Build the local repo of the packages of targets in directory.
+
+    Returns the path of the repo.
+    """
+    rpms = sorted(glob.glob(os.path.join(args.OfflineRepo, '*.rpm')) +
+                  glob.glob(BUNDLED_RPMS))
+    candidates = os.path.join(directory, 'candidates')
+    create_repo(candidates, rpms)
+    names = _package_names(targets)
+    packages, unresolved = dependency_closure(
+        parse_primary(read_metadata('file://' + candidates, 'primary')),
+        names)
+    found = set(package.name for package in packages)
+    missing = sorted(names - found)
+    if missing:
+        logger.warning('Not in %s, must already be installed in the '
+                       'images: %s' % (args.OfflineRepo, ' '.join(missing)))
+    if unresolved:
+        logger.warning('Dependencies the images must provide: %s' %
+                       ' '.join(sorted(unresolved)))
+    repo = os.path.join(directory, OFFLINE_REPO_NAME)
+    create_repo(repo, [os.path.join(candidates,
+                                    os.path.basename(package.location))
+                       for package in packages])
+    shutil.rmtree(candidates)
+    logger.info('Local repo of %d of %d RPMs built' % (len(packages),
+                                                       len(rpms)))
+    return repo
+
+
+def main():
+    parser = init_arg_parser()
+    args = parser.parse_args()
+    if args.Targets:
+        targets = read_targets(parser, args)
+    elif not (args.ImageName and args.Version):
+        parser.error('--ImageName and --Version are required')
+    else:
+        check_args(parser, args)
+        targets = [args]
+
+    if not args.DryRun:
+        logger.info('Verifying pre-requisite packages for script')
+        if not have_libguestfs_tools():
+            logger.error('Please install libguestfs-tools-c package for '
+                         'the script to run')
+            sys.exit(1)
+
+    start = time.time()
+    rpms = None
+    offline_repo = None
+    repo_dir = None
+    try:
+        if args.RpmCacheDir:
+            rpms = fetch_rpms(args, targets)
+        if args.OfflineRepo:
+            repo_dir = tempfile.mkdtemp(prefix='nuage-repo-')
+            offline_repo = build_offline_repo(args, targets, repo_dir)
+        if not args.Targets:
+            report = patch(args, rpms, offline_repo=offline_repo)
+        else:
+            jobs = args.Jobs or default_jobs(args.MemSize, len(targets))
+            logger.info('Patching %d images, %d at a time' %
+                        (len(targets), jobs))
+            pool = multiprocessing.Pool(jobs)
+            try:
+                reports = pool.map(_patch_target,
+                                   [(target, rpms, offline_repo)
+                                    for target in targets],
+                                   chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+            report = {'jobs': jobs, 'targets': reports,
+                      'total_seconds': time.time() - start}
+            for target in reports:
+                logger.info('%-40s %8s' % (
+                    target['image'], 'failed' if 'error' in target
+                    else '%.1fs' % target['total_seconds']))
+            logger.info('%-40s %7.1fs' % ('total', report['total_seconds']))
+    except (OSError, RpmCacheError, subprocess.CalledProcessError) as e:
+        logger.error('Failed to patch %s: %s' % (args.ImageName or
+                                                 args.Targets, e))
+        sys.exit(1)
+    finally:
+        if repo_dir:
+            shutil.rmtree(repo_dir)
+    if args.DryRun:
+        return
+
+    if args.Report:
+        with open(args.Report, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if any('error' in target for target in report.get('targets', [])):
+        sys.exit(1)
+    logger.info('Done')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+# Copyright 2015 Alcatel-Lucent USA Inc.
+# All Rights Reserved.
+
+"""Host-side handling of yum repositories and their RPMs.
+
+RpmCache looks packages up in the repodata of a repo and downloads them
+once into a directory shared by all the images patched from it. Each
+RPM is stored under the checksum the repodata gives for it and is only
+moved into place once its content matches that checksum, so that a
+file found in the cache never needs to be downloaded or verified again.
+
+create_repo and dependency_closure build a self-contained local repo
+out of a set of RPMs, for images patched without network access.
+"""
+
+import errno
+import fcntl
+import gzip
+import hashlib
+import io
+import logging
+import os
+import re
+import shutil
+import subprocess
+import xml.etree.ElementTree as ElementTree
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    # Python 2
+    from urllib2 import urlopen
+
+LOG = logging.getLogger(__name__)
+CHUNK_SIZE = 1024 * 1024
+REPO_NS = '{http://linux.duke.edu/metadata/repo}'
+COMMON_NS = '{http://linux.duke.edu/metadata/common}'
+RPM_NS = '{http://linux.duke.edu/metadata/rpm}'
+CREATEREPO_COMMANDS = ('createrepo_c', 'createrepo')
+
+
+class RpmCacheError(Exception):
+    pass
+
+
+def _hash(checksum_type):
+    # createrepo calls sha1 "sha"
+    return hashlib.new('sha1' if checksum_type == 'sha' else checksum_type)
+
+
+def _version_key(version):
+    """Return a sort key of a version string, close to rpmvercmp."""
+    return [(1, int(part)) if part.isdigit() else (0, part)
+            for part in re.findall(r'\d+|[a-zA-Z]+', version or '')]
+
+
+class Package(object):
+    """A package of the repodata.
+
+    :param checksum: (type, hex digest) of the RPM file.
+    :param provides: The capabilities and files the package provides,
+        without their versions.
+    :param requires: The capabilities and files it requires.
+    """
+
+    def __init__(self, name, arch, epoch, version, release, location,
+                 checksum, provides=(), requires=()):
+        self.name = name
+        self.arch = arch
+        self.evr = (int(epoch or 0), _version_key(version),
+                    _version_key(release))
+        self.location = location
+        self.checksum = checksum
+        self.provides = set(provides)
+        self.provides.add(name)
+        self.requires = set(requires)
+
+
+def _entries(format_elem, tag):
+    if format_elem is None:
+        return []
+    return [entry.get('name') for entry in
+            format_elem.findall('%s%s/%sentry' % (RPM_NS, tag, RPM_NS))]
+
+
+def parse_primary(data):
+    """Return the Packages of a primary.xml document, except sources."""
+    packages = []
+    for _event, elem in ElementTree.iterparse(io.BytesIO(data)):
+        if elem.tag != COMMON_NS + 'package':
+            continue
+        arch = elem.findtext(COMMON_NS + 'arch')
+        if arch != 'src':
+            version = elem.find(COMMON_NS + 'version')
+            checksum = elem.find(COMMON_NS + 'checksum')
+            format_elem = elem.find(COMMON_NS + 'format')
+            files = []
+            if format_elem is not None:
+                files = [f.text for f in format_elem.findall(COMMON_NS +
+                                                             'file')]
+            packages.append(Package(
+                elem.findtext(COMMON_NS + 'name'), arch,
+                version.get('epoch'), version.get('ver'),
+                version.get('rel'),
+                elem.find(COMMON_NS + 'location').get('href'),
+                (checksum.get('type'), checksum.text.strip()),
+                _entries(format_elem, 'provides') + files,
+                _entries(format_elem, 'requires')))
+        elem.clear()
+    return packages
+
+
+def _read(url):
+    response = urlopen(url, timeout=60)
+    try:
+        return response.read()
+    finally:
+        response.close()
+
+
+def read_metadata(base_url, data_type):
+    """Return a verified, uncompressed metadata file of a repo.
+
+    :param base_url: The base URL of the repo, file:// ones included.
+    :param data_type: The type of the metadata, like 'primary'.
+    """
+    repomd = ElementTree.fromstring(_read(base_url + '/repodata/repomd.xml'))
+    for data in repomd.findall(REPO_NS + 'data'):
+        if data.get('type') != data_type:
+            continue
+        href = data.find(REPO_NS + 'location').get('href')
+        checksum = data.find(REPO_NS + 'checksum')
+        content = _read(base_url + '/' + href)
+        digest = _hash(checksum.get('type'))
+        digest.update(content)
+        if digest.hexdigest() != checksum.text.strip():
+            raise RpmCacheError('Checksum mismatch of %s' % href)
+        if href.endswith('.gz'):
+            content = gzip.GzipFile(fileobj=io.BytesIO(content)).read()
+        return content
+    raise RpmCacheError('No %s metadata in %s' % (data_type, base_url))
+
+
+def latest_packages(packages, arch='x86_64'):
+    """Return a dict of name to the latest of packages for an arch."""
+    latest = {}
+    for package in packages:
+        if package.arch not in (arch, 'noarch'):
+            continue
+        if (package.name not in latest or
+                package.evr > latest[package.name].evr):
+            latest[package.name] = package
+    return latest
+
+
+def dependency_closure(packages, names):
+    """Return the packages needed to install names from packages.
+
+    Versions are not compared: the latest package of each name is taken
+    and any of them providing a requirement satisfies it.
+
+    :returns: A (packages, unresolved) tuple of the list of Packages of
+        names and their dependencies, and of the set of requirements no
+        package provides, which the image has to provide itself.
+    """
+    latest = latest_packages(packages)
+    providers = {}
+    for package in sorted(latest.values(), key=lambda p: p.name):
+        for capability in package.provides:
+            providers.setdefault(capability, package)
+    selected = {}
+    unresolved = set()
+    pending = [latest[name] for name in names if name in latest]
+    while pending:
+        package = pending.pop()
+        if package.name in selected:
+            continue
+        selected[package.name] = package
+        for requirement in package.requires:
+            if requirement.startswith('rpmlib('):
+                continue
+            provider = providers.get(requirement)
+            if provider is None:
+                unresolved.add(requirement)
+            elif provider.name not in selected:
+                pending.append(provider)
+    return ([selected[name] for name in sorted(selected)],
+            unresolved)
+
+
+def create_repo(directory, rpms):
+    """Make directory a yum repo of a list of RPM files.
+
+    The RPMs are hard linked into directory when possible.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for rpm in rpms:
+        path = os.path.join(directory, os.path.basename(rpm))
+        try:
+            os.link(rpm, path)
+        except OSError:
+            shutil.copyfile(rpm, path)
+    for command in CREATEREPO_COMMANDS:
+        try:
+            subprocess.check_call([command, '--quiet', directory])
+            return
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    raise RpmCacheError('Please install createrepo_c or createrepo to '
+                        'build a local repo')
+
+
+class RpmCache(object):
+    """Directory of RPMs named after their checksum.
+
+    :param directory: The cache directory, created if needed.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def path(self, package):
+        return os.path.join(self.directory, package.checksum[0],
+                            package.checksum[1],
+                            os.path.basename(package.location))
+
+    def _download(self, base_url, package):
+        path = self.path(package)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Several processes may fetch the same package at once
+        with open(os.path.join(directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(path):
+                return path
+            LOG.info('Downloading %s', package.location)
+            tmp_path = path + '.tmp'
+            digest = _hash(package.checksum[0])
+            response = urlopen(base_url + '/' + package.location, timeout=60)
+            try:
+                with open(tmp_path, 'wb') as f:
+                    for chunk in iter(lambda: response.read(CHUNK_SIZE),
+                                      b''):
+                        digest.update(chunk)
+                        f.write(chunk)
+            finally:
+                response.close()
+            if digest.hexdigest() != package.checksum[1]:
+                os.remove(tmp_path)
+                raise RpmCacheError('Checksum mismatch of %s' %
+                                    package.location)
+            os.rename(tmp_path, path)
+        return path
+
+    def fetch(self, base_url, names, arch='x86_64'):
+        """Download the latest version of packages of a repo.
+
+        :param names: The names of the packages to fetch.
+        :returns: A dict of name to the path of the cached RPM, for the
+            names found in the repo.
+        """
+        base_url = base_url.rstrip('/')
+        latest = latest_packages(parse_primary(read_metadata(base_url,
+                                                             'primary')),
+                                 arch)
+        return dict((name, self._download(base_url, package))
+                    for name, package in latest.items() if name in names)
@@ -0,0 +1,71 @@
+# Copyright 2015 Alcatel-Lucent USA Inc.
+# All Rights Reserved.
+
+"""Tests of the patch plans of nuage_overcloud_full_patch.py."""
+
+import argparse
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+import nuage_overcloud_full_patch as patch  # noqa
+
+
+def _args(**kwargs):
+    args = dict(ImageName='overcloud-full.qcow2', RhelUserName='user',
+                RhelPassword='password', RhelPool='pool',
+                RepoName='Nuage', RepoBaseUrl='http://repo/nuage',
+                Version=9, Cbis=False, OfflineRepo=None)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def _yum_lines(step):
+    return [line for script in step.scripts.values()
+            for line in script.splitlines() if line.startswith('yum ')]
+
+
+class TestOfflineRepo(unittest.TestCase):
+
+    offline_repo = '/var/tmp/nuage-offline-repo'
+
+    def check(self, steps):
+        self.assertNotIn('subscribe', steps)
+        uninstall = _yum_lines(steps['uninstall'])
+        self.assertEqual(["yum --disablerepo='*' remove python-openvswitch -y",
+                          "yum --disablerepo='*' remove openvswitch -y"],
+                         uninstall)
+        for name in ('packages', 'vrs'):
+            for line in _yum_lines(steps[name]):
+                self.assertTrue(line.startswith(
+                    "yum --disablerepo='*' --enablerepo=Nuage install "),
+                    line)
+
+    def test_plan(self):
+        args = _args(OfflineRepo=self.offline_repo)
+        plan = patch.build_plan(args, offline_repo=self.offline_repo)
+        self.check(dict((step.name, step) for step in plan))
+
+    def test_layered(self):
+        # The uninstall stage has no Nuage repo at all
+        args = _args(OfflineRepo=self.offline_repo)
+        stages = patch.build_stages(args, layered=True,
+                                    offline_repo=self.offline_repo)
+        self.assertNotIn('repo', [step.name for step in dict(stages)[
+            'uninstall']])
+        self.check(dict((step.name, step) for _stage, steps in stages
+                        for step in steps))
+
+    def test_online(self):
+        steps = dict((step.name, step) for step in patch.build_plan(_args()))
+        self.assertIn('subscribe', steps)
+        for name in ('uninstall', 'packages', 'vrs'):
+            for line in _yum_lines(steps[name]):
+                self.assertNotIn('--disablerepo', line)
+
+
+if __name__ == '__main__':
+    unittest.main()
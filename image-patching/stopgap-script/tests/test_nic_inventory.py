@@ -0,0 +1,138 @@
+# Copyright 2015 Alcatel-Lucent USA Inc.
+# All Rights Reserved.
+
+"""Tests of NicInventory of 7_files/impl_ifcfg.py, and of the MAC lookups
+of IfcfgNetConfig that use it, against a fake sysfs.
+
+impl_ifcfg.py is the os-net-config provider patched into the images, so
+these run with the Python 2 and os-net-config of the overcloud:
+
+    python -m unittest discover -s tests
+"""
+
+import errno
+import imp
+import os
+import shutil
+import tempfile
+import unittest
+
+from os_net_config import objects
+
+IMPL_IFCFG = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), '7_files', 'impl_ifcfg.py')
+impl_ifcfg = imp.load_source('impl_ifcfg', IMPL_IFCFG)
+
+
+class FakeSysfsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root_dir)
+        self.sys_class_net = self.root_dir + impl_ifcfg.sys_class_net_path()
+        os.makedirs(self.sys_class_net)
+
+    def add_nic(self, name, **attributes):
+        path = os.path.join(self.sys_class_net, name)
+        os.mkdir(path)
+        for attribute, value in attributes.items():
+            with open(os.path.join(path, attribute), 'w') as f:
+                f.write(value + '\n')
+        return path
+
+
+class TestNicInventory(FakeSysfsTestCase):
+
+    def test_attributes(self):
+        self.add_nic('em1', address='52:54:00:00:00:01', operstate='up',
+                     mtu='9000')
+        inventory = impl_ifcfg.NicInventory(self.root_dir)
+        self.assertEqual({'address': '52:54:00:00:00:01',
+                          'operstate': 'up', 'mtu': 9000, 'master': None},
+                         inventory.get('em1'))
+        self.assertEqual('52:54:00:00:00:01', inventory.mac('em1'))
+
+    def test_master(self):
+        self.add_nic('bond0', address='52:54:00:00:00:01')
+        path = self.add_nic('em1', address='52:54:00:00:00:01')
+        os.symlink('../bond0', os.path.join(path, 'master'))
+        inventory = impl_ifcfg.NicInventory(self.root_dir)
+        self.assertEqual('bond0', inventory.get('em1')['master'])
+        self.assertIsNone(inventory.get('bond0')['master'])
+
+    def test_unreadable_attributes(self):
+        self.add_nic('em1', mtu='not a number')
+        nic = impl_ifcfg.NicInventory(self.root_dir).get('em1')
+        self.assertEqual({'address': None, 'operstate': None, 'mtu': None,
+                          'master': None}, nic)
+
+    def test_unknown_nic(self):
+        inventory = impl_ifcfg.NicInventory(self.root_dir)
+        self.assertIsNone(inventory.get('em1'))
+        with self.assertRaises(IOError) as context:
+            inventory.mac('em1')
+        self.assertEqual(errno.ENOENT, context.exception.errno)
+
+    def test_nic_without_address(self):
+        self.add_nic('em1', operstate='down')
+        self.assertRaises(IOError,
+                          impl_ifcfg.NicInventory(self.root_dir).mac, 'em1')
+
+    def test_root_dir_without_sysfs(self):
+        # The host's NICs must not be read instead
+        shutil.rmtree(self.sys_class_net)
+        inventory = impl_ifcfg.NicInventory(self.root_dir)
+        self.assertEqual({}, inventory.nics)
+
+    def test_no_root_dir(self):
+        self.add_nic('em1', address='52:54:00:00:00:01')
+        sys_class_net_path = impl_ifcfg.sys_class_net_path
+        self.addCleanup(setattr, impl_ifcfg, 'sys_class_net_path',
+                        sys_class_net_path)
+        impl_ifcfg.sys_class_net_path = lambda: self.sys_class_net
+        inventory = impl_ifcfg.NicInventory()
+        self.assertEqual(self.sys_class_net, inventory.path)
+        self.assertEqual('52:54:00:00:00:01', inventory.mac('em1'))
+
+
+class TestIfcfgNetConfigRootDir(FakeSysfsTestCase):
+
+    def setUp(self):
+        super(TestIfcfgNetConfigRootDir, self).setUp()
+        self.add_nic('em1', address='52:54:00:00:00:01')
+        # os-net-config reads the host's sysfs, it must not be used
+        interface_mac = impl_ifcfg.utils.interface_mac
+        self.addCleanup(setattr, impl_ifcfg.utils, 'interface_mac',
+                        interface_mac)
+        impl_ifcfg.utils.interface_mac = self.fail
+        self.provider = impl_ifcfg.IfcfgNetConfig(noop=True,
+                                                  root_dir=self.root_dir)
+
+    def bridge(self, bridge_type, name, nic_name):
+        return objects.object_from_json({
+            'type': bridge_type, 'name': name, 'mtu': 1500,
+            'members': [{'type': 'interface', 'name': nic_name,
+                         'mtu': 1500, 'primary': True}]})
+
+    def test_ovs_bridge(self):
+        self.provider.add_bridge(self.bridge('ovs_bridge', 'br-ex', 'em1'))
+        self.assertIn('OVS_EXTRA="set bridge br-ex '
+                      'other-config:hwaddr=52:54:00:00:00:01"',
+                      self.provider.bridge_data['br-ex'])
+        self.assertEqual(self.sys_class_net,
+                         self.provider.nic_inventory.path)
+
+    def test_linux_bridge(self):
+        self.provider.add_linux_bridge(self.bridge('linux_bridge', 'br-ctl',
+                                                   'em1'))
+        self.assertIn('MACADDR="52:54:00:00:00:01"',
+                      self.provider.linuxbridge_data['br-ctl'])
+
+    def test_nic_only_on_the_host(self):
+        # lo is in the host's sysfs, not in the one under root_dir
+        bridge = self.bridge('ovs_bridge', 'br-ex', 'lo')
+        self.assertRaises(IOError, self.provider.add_bridge, bridge)
+
+
+if __name__ == '__main__':
+    unittest.main()
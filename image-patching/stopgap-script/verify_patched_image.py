@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# Copyright 2015 Alcatel-Lucent USA Inc.
+# All Rights Reserved.
+
+"""Check an image patched by nuage_overcloud_full_patch in one session.
+
+The image is opened read-only with libguestfs, once, and checked for:
+
+- the rpmdb: nuage-openvswitch and the Nuage packages installed,
+  openvswitch (and python-openvswitch up to version 9) removed
+- the files of --Version, in /etc/puppet/modules/nuage/manifests and at
+  their destinations, having the same sha256 as the ones shipped in
+  <Version>_files
+- nuage.repo and the RPMs copied in for the install being removed
+- the image not being registered to RHEL any more
+- the StandardInput=tty line removed from rhel-autorelabel.service
+
+A JSON pass/fail report is printed, or written to --Report, and the exit
+status is 1 if any check failed:
+
+    python verify_patched_image.py --ImageName=overcloud-full.qcow2 \\
+        --Version=9 --Report=verify.json
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+from nuage_overcloud_full_patch import AUTORELABEL_EDIT
+from nuage_overcloud_full_patch import CBIS_NUAGE_PACKAGES
+from nuage_overcloud_full_patch import FILES_DIR
+from nuage_overcloud_full_patch import MANIFESTS_DIR
+from nuage_overcloud_full_patch import NUAGE_PACKAGES
+from nuage_overcloud_full_patch import NUAGE_REPO
+from nuage_overcloud_full_patch import NUAGE_VRS_PACKAGE
+from nuage_overcloud_full_patch import OFFLINE_REPO_NAME
+from nuage_overcloud_full_patch import OFFLINE_REPO_PARENT
+from nuage_overcloud_full_patch import RPMS_DIR
+from nuage_overcloud_full_patch import VERSION_FILES
+from nuage_overcloud_full_patch import VERSIONS
+
+# created by subscription-manager register, removed by unregister
+CONSUMER_CERT = '/etc/pki/consumer/cert.pem'
+AUTORELABEL_SERVICE = AUTORELABEL_EDIT.split(':', 1)[0]
+
+
+def _sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class Checks(object):
+    """The results of the checks of an image."""
+
+    def __init__(self):
+        self.results = []
+
+    def add(self, name, passed, detail=None):
+        self.results.append({'name': name, 'passed': bool(passed),
+                             'detail': detail})
+
+    @property
+    def passed(self):
+        return all(result['passed'] for result in self.results)
+
+
+def check_image(g, version, cbis=False):
+    """Run the checklist of a version on a launched, mounted guestfs.
+
+    Returns the Checks.
+    """
+    checks = Checks()
+    root = g.inspect_get_roots()[0]
+    installed = set(app['app2_name']
+                    for app in g.inspect_list_applications2(root))
+    for package in [NUAGE_VRS_PACKAGE] + (CBIS_NUAGE_PACKAGES if cbis
+                                          else NUAGE_PACKAGES):
+        checks.add('installed %s' % package, package in installed)
+    removed = ['openvswitch']
+    if version <= 9:
+        removed.append('python-openvswitch')
+    for package in removed:
+        checks.add('removed %s' % package, package not in installed)
+
+    for name, destination in VERSION_FILES[version]:
+        expected = _sha256(os.path.join(FILES_DIR, '%d_files' % version,
+                                        name))
+        for path in ('%s/%d_files/%s' % (MANIFESTS_DIR, version, name),
+                     destination):
+            if not g.is_file(path):
+                checks.add('file %s' % path, False, 'missing')
+                continue
+            actual = g.checksum('sha256', path)
+            checks.add('file %s' % path, actual == expected,
+                       None if actual == expected else
+                       'sha256 %s, expected %s' % (actual, expected))
+
+    for path in (NUAGE_REPO, RPMS_DIR,
+                 '%s/%s' % (OFFLINE_REPO_PARENT, OFFLINE_REPO_NAME)):
+        checks.add('removed %s' % path, not g.exists(path))
+    registered = g.exists(CONSUMER_CERT)
+    checks.add('unsubscribed', not registered,
+               '%s exists' % CONSUMER_CERT if registered else None)
+    if g.is_file(AUTORELABEL_SERVICE):
+        checks.add('edited %s' % AUTORELABEL_SERVICE,
+                   not g.grep('^StandardInput=tty', AUTORELABEL_SERVICE))
+    return checks
+
+
+def open_image(image):
+    """Return a guestfs handle with image mounted read-only."""
+    import guestfs
+    g = guestfs.GuestFS(python_return_dict=True)
+    g.add_drive_opts(image, readonly=1)
+    g.launch()
+    roots = g.inspect_os()
+    if not roots:
+        raise RuntimeError('No operating system found in %s' % image)
+    mountpoints = g.inspect_get_mountpoints(roots[0])
+    for mountpoint in sorted(mountpoints, key=len):
+        g.mount_ro(mountpoints[mountpoint], mountpoint)
+    return g
+
+
+def init_arg_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.split('\n')[2:]))
+    parser.add_argument('--ImageName', required=True,
+                        help='Name of the patched qcow2 image')
+    parser.add_argument('--Version', type=int, required=True,
+                        choices=VERSIONS,
+                        help='OSP-Director version the image was patched '
+                             'for')
+    parser.add_argument('--Cbis', action='store_true',
+                        help='The image was patched with --Cbis')
+    parser.add_argument('--Report',
+                        help='Write the report to this JSON file')
+    return parser
+
+
+def main():
+    args = init_arg_parser().parse_args()
+    start = time.time()
+    try:
+        g = open_image(args.ImageName)
+    except ImportError:
+        sys.stderr.write('Please install the python-libguestfs package '
+                         'for the script to run\n')
+        sys.exit(2)
+    except RuntimeError as e:
+        sys.stderr.write('Failed to open %s: %s\n' % (args.ImageName, e))
+        sys.exit(2)
+    try:
+        checks = check_image(g, args.Version, args.Cbis)
+    finally:
+        g.close()
+
+    report = {'image': args.ImageName, 'version': args.Version,
+              'cbis': args.Cbis, 'passed': checks.passed,
+              'seconds': time.time() - start, 'checks': checks.results}
+    if args.Report:
+        with open(args.Report, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    if not checks.passed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()